@@ -7,7 +7,17 @@
 import os
 import sys
 import json
+import asyncio
+import functools
+import hashlib
+import mmap
+import array
+import bisect
 import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 if sys.platform == "win32":
     ENCODING = "ANSI"
@@ -17,10 +27,159 @@ else:
     ENCODING = "utf-8"
 
 
+def _normpath(path):
+    """Returns the normalized key of a path in the Asar archive (``/`` separated)."""
+    return path.replace("\\", "/").strip("/")
+
+
+def _kernel_copy(src_fd, dst_fd, offset, size):
+    """Copies bytes from ``src_fd`` at ``offset`` to ``dst_fd`` inside the kernel.
+
+    ``os.copy_file_range`` is tried first, then ``os.sendfile``. Neither moves the
+    file pointer of ``src_fd``. Returns the number of bytes copied, which is less
+    than ``size`` if the platform or file system does not support kernel copies.
+    """
+    copied = 0
+    for name in ("copy_file_range", "sendfile"):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        try:
+            while copied < size:
+                if name == "copy_file_range":
+                    n = func(src_fd, dst_fd, size - copied, offset + copied)
+                else:
+                    n = func(dst_fd, src_fd, offset + copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            continue
+        if copied == size:
+            break
+    return copied
+
+
 class AsarFileHeaderError(KeyError):
     pass
 
 
+_async_executor = None
+_async_executor_lock = threading.Lock()
+
+
+def _get_async_executor():
+    """Returns the shared, bounded thread pool used by the async read methods."""
+    global _async_executor
+    with _async_executor_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(thread_name_prefix="asarlib")
+        return _async_executor
+
+
+# Sidecar index file: fixed size head followed by the offsets and sizes of all
+# entries (little-endian int64, -1 for directories), the number of entries of each
+# directory (int64), the newline-separated directory paths and the newline-separated
+# entry names of all directories in header order.
+_SIDECAR_MAGIC = b"ASARIDX\x00"
+_SIDECAR_VERSION = 2
+_SIDECAR_HEAD = struct.Struct("<8sIQqQQQQQ")
+
+
+class _DirNode:
+    """Directory of the compact index.
+
+    Stores the names of the entries in header order as a tuple together with arrays
+    of their offsets and sizes. Subdirectories have an offset of -1 and files without data in
+    the archive (e.g. unpacked files) an offset of -2.
+    """
+
+    __slots__ = ("names", "offsets", "sizes", "_lookup")
+
+    def __init__(self, names, offsets, sizes):
+        self.names = names
+        self.offsets = offsets
+        self.sizes = sizes
+        self._lookup = None
+
+    def find(self, name):
+        """Returns the position of the entry ``name`` or -1 if it does not exist."""
+        names = self.names
+        if self._lookup is None:
+            # Archives written by ``asar pack`` list the entries sorted by name, so
+            # a binary search is enough. Otherwise, a dictionary is built once.
+            if all(names[i] < names[i + 1] for i in range(len(names) - 1)):
+                self._lookup = True
+            else:
+                self._lookup = {n: i for i, n in enumerate(names)}
+        if self._lookup is True:
+            i = bisect.bisect_left(names, name)
+            return i if i < len(names) and names[i] == name else -1
+        return self._lookup.get(name, -1)
+
+
+class _CompactFileIndex:
+    """Read-only ``path -> (offset, size)`` mapping backed by ``_DirNode`` objects.
+
+    Stores a single name string and two array items per entry instead of a
+    dictionary per entry like the JSON header, which reduces the memory usage of
+    archives with millions of entries by several times.
+    """
+
+    __slots__ = ("nodes",)
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    @classmethod
+    def from_header(cls, files):
+        nodes = dict()
+        parents = [("", files)]
+        while parents:
+            root, parent = parents.pop()
+            offsets, sizes = array.array("q"), array.array("q")
+            for name, item in parent.items():
+                if "files" in item:
+                    parents.append((f"{root}/{name}" if root else name, item["files"]))
+                    offsets.append(-1)
+                    sizes.append(-1)
+                else:
+                    offsets.append(int(item["offset"]) if "offset" in item else -2)
+                    sizes.append(int(item.get("size", 0)))
+            nodes[root] = _DirNode(tuple(parent.keys()), offsets, sizes)
+        return cls(nodes)
+
+    def _find(self, path):
+        root, _, name = path.rpartition("/")
+        node = self.nodes.get(root)
+        if node is not None:
+            i = node.find(name)
+            if i >= 0 and node.offsets[i] >= 0:
+                return node, i
+        return None, -1
+
+    def __getitem__(self, path):
+        node, i = self._find(path)
+        if node is None:
+            raise KeyError(path)
+        return node.offsets[i], node.sizes[i]
+
+    def __contains__(self, path):
+        return self._find(path)[0] is not None
+
+    def __len__(self):
+        return sum(sum(1 for o in node.offsets if o >= 0) for node in self.nodes.values())
+
+    def items(self):
+        for root, node in self.nodes.items():
+            for name, offset, size in zip(node.names, node.offsets, node.sizes):
+                if offset >= 0:
+                    yield (f"{root}/{name}" if root else name), (offset, size)
+
+    def clear(self):
+        self.nodes = dict()
+
+
 class AsarFile:
     """Electron Asar archive file handler.
 
@@ -33,12 +192,55 @@ class AsarFile:
         The mode for opening the Asar file. The default is 'r' (read).
     encoding : str, optional
         The encoding of the Asar archive. The default is platform specific.
+    use_mmap : bool, optional
+        If True, the archive is memory-mapped when opened and ``read_file`` with
+        ``decode=False`` returns zero-copy ``memoryview`` slices of the mapping
+        instead of new ``bytes`` objects. The default is False.
+    sidecar : bool or str, optional
+        If True, the path index of the archive is cached in a compact binary file
+        next to the archive (the archive path with ``idx`` appended, for example
+        ``slide.medidx``). A string is used as the path of the index file. The
+        default is False.
+    compact : bool, optional
+        If True, the parsed JSON header is replaced by a compact array-backed index
+        which uses several times less memory for archives with many entries, at the
+        cost of slightly slower lookups. Indices loaded from a sidecar file are
+        always compact. The default is False.
 
     Attributes
     ----------
     headers : dict
         The header data of the Asar archive as dictionary. Stores the byte position
-        and size of the files contained in the Asar file content.
+        and size of the files contained in the Asar file content. If the index is
+        compact or was loaded from a sidecar file, the header is only parsed on first
+        access of this attribute. ``get_header``, ``walk``, ``listdir`` and
+        ``treestr`` use the index instead.
+
+    Notes
+    -----
+    When the archive is opened a flat index of the header is built, mapping each
+    file path to its ``(offset, size)`` and each directory path to the names of
+    its entries. ``read_file``, ``listdir``, ``walk`` and the extraction methods
+    look up entries in this index instead of walking the nested header.
+
+    With ``sidecar`` enabled the index is stored in a binary file as entry names
+    with offset and size arrays, together with the size and modification time of
+    the archive. As long as these match, opening the archive skips parsing the JSON
+    header entirely. Otherwise, the index is rebuilt and the sidecar file rewritten.
+
+    The file contents are read with positional reads (``os.pread``) which do not
+    move a shared file pointer, or from the memory map if ``use_mmap=True``. On
+    platforms without ``os.pread`` the reads are serialized by a lock instead.
+    This makes ``read_file``, ``read_many``, ``extract_file``, ``extract``,
+    ``get_header``, ``listdir``, ``isfile``, ``isdir``, ``walk``, ``walk_files``
+    and ``treestr`` safe to call from multiple threads on the same open instance.
+    ``open``, ``close``, ``seek``, ``tell`` and ``read`` use or modify the shared
+    state of the instance and must not be called concurrently.
+
+    ``read_file_async`` and ``read_many_async`` run the reads on a bounded thread
+    pool (shared by all instances unless an executor is passed), so many requests
+    can be served concurrently from one open archive without blocking the event
+    loop.
 
     Examples
     --------
@@ -57,6 +259,11 @@ class AsarFile:
     >>> with AsarFile("file.asar") as asar
     ...     data = asar.read_file("folder/file.txt")
 
+    Read the raw bytes of a file without copying them out of the archive:
+
+    >>> with AsarFile("file.asar", use_mmap=True) as asar
+    ...     buf = asar.read_file("folder/file.bin", decode=False)  # memoryview
+
     Extract a file from the archive:
 
     >>> dst_dir = "asar_contents"
@@ -74,12 +281,23 @@ class AsarFile:
     ...     asar.extract(dst=dst_dir)
     """
 
-    def __init__(self, file=None, mode="r", encoding=None):
+    def __init__(self, file=None, mode="r", encoding=None, use_mmap=False, sidecar=False,
+                 compact=False):
         self._encoding = encoding or ENCODING
+        self._use_mmap = use_mmap
+        self._sidecar = sidecar
+        self._compact = compact
+        self._header_start = 0
+        self._header_size = 0
         self._content_offset = 0
         self._fh = None
+        self._lock = threading.Lock()
+        self._mm = None
+        self._view = None
+        self._files = dict()
+        self._dirs = dict()
 
-        self.headers = dict()
+        self._headers = dict()
         if file is not None:
             self.open(file, mode)
 
@@ -88,7 +306,19 @@ class AsarFile:
         """str: The encoding of the Asar file."""
         return self._encoding
 
-    def open(self, file, mode="r"):
+    @property
+    def headers(self):
+        """dict: The header data of the Asar archive."""
+        if self._headers is None:
+            self._headers = self._read_headers()
+        return self._headers
+
+    @property
+    def mmapped(self):
+        """bool: True if the Asar file content is memory-mapped."""
+        return self._mm is not None
+
+    def open(self, file, mode="r", use_mmap=None, sidecar=None):
         """Open an Asar file.
 
         Parameters
@@ -97,11 +327,17 @@ class AsarFile:
             The file path of the Asar file to open.
         mode : {'r', 'w'} str, optional
             The mode for opening the Asar file. The default is 'r' (read).
+        use_mmap : bool, optional
+            If True, the Asar file is memory-mapped. If not given the value passed
+            to the constructor is used.
+        sidecar : bool or str, optional
+            If True or a path, the index is loaded from or saved to a sidecar file.
+            If not given the value passed to the constructor is used.
         """
         # Open the file handler
         mode = mode.rstrip("b")
         if mode == "w":
-            raise NotImplementedError("Writing Asar headers is not yet supported!")
+            raise NotImplementedError("Use AsarWriter for creating Asar archives!")
         self._fh = open(file, f"{mode}b")
 
         # Parse the Asar file tags:
@@ -118,25 +354,195 @@ class AsarFile:
         header_start = 12 + len_size
         len_header -= 8  # Subtract 8 bytes padding
 
-        # Read the actual Asar header.
-        # The header is a JSON string storing the information about the contents in the
-        # ASAR file.
-        self._fh.seek(header_start)
-        header_data: bytes = self._fh.read(len_header)  # noqa
-        if header_data.endswith(b"\x00"):
-            header_data = header_data.rstrip(b"\x00")
-        self.headers = json.loads(header_data.decode(self._encoding))
-
         # Store start of content (after header)
+        self._header_start = header_start
+        self._header_size = len_header
         self._content_offset = header_start + len_header
 
+        # Load the index from the sidecar file if it is up-to-date, otherwise
+        # read the actual Asar header and build the index from it.
+        if sidecar is None:
+            sidecar = self._sidecar
+        sidecar_path = None
+        if sidecar:
+            sidecar_path = f"{file}idx" if sidecar is True else sidecar
+        if sidecar_path is None or not self._load_sidecar(sidecar_path):
+            self._headers = self._read_headers()
+            self._build_index()
+            if sidecar_path is not None:
+                self._save_sidecar(sidecar_path)
+            if self._compact:
+                # Drop the nested header, it is parsed again if accessed
+                self._files = _CompactFileIndex.from_header(self._headers["files"])
+                self._dirs = {root: node.names for root, node in self._files.nodes.items()}
+                self._headers = None
+
+        # Map the whole file once. The content section itself usually does not
+        # start at a page boundary, so slices are taken relative to the content
+        # offset instead of mapping only the content section.
+        if use_mmap is None:
+            use_mmap = self._use_mmap
+        if use_mmap:
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mm)
+
     def close(self):
-        """Closes the Asar file if it is still open."""
+        """Closes the Asar file if it is still open.
+
+        Notes
+        -----
+        If ``memoryview`` buffers returned by ``read_file`` are still alive, the
+        memory map stays valid until the last of them is released.
+        """
+        if self._mm is not None:
+            self._view.release()
+            try:
+                self._mm.close()
+            except BufferError:
+                # Slices handed out by ``read_file`` still reference the map, it is
+                # unmapped as soon as they are garbage collected.
+                pass
+            self._mm = None
+            self._view = None
         if self._fh is not None:
             self._fh.close()
             self._fh = None
             self._content_offset = 0
-            self.headers.clear()
+            self._headers = dict()
+            self._files.clear()
+            self._dirs.clear()
+
+    def _read_headers(self):
+        """Reads and parses the JSON header of the open Asar file."""
+        # The header is a JSON string storing the information about the contents in
+        # the ASAR file.
+        header_data = bytes(self._read_range(self._header_start - self._content_offset,
+                                             self._header_size))
+        if header_data.endswith(b"\x00"):
+            header_data = header_data.rstrip(b"\x00")
+        return json.loads(header_data.decode(self._encoding))
+
+    def _load_sidecar(self, path):
+        """Loads the index from a sidecar file. Returns False if it is missing or stale."""
+        stat = os.fstat(self._fh.fileno())
+        try:
+            with open(path, "rb") as fh:
+                head = fh.read(_SIDECAR_HEAD.size)
+                if len(head) < _SIDECAR_HEAD.size:
+                    return False
+                magic, version, size, mtime, content_offset, ndirs, nentries, len_dirs, len_names = \
+                    _SIDECAR_HEAD.unpack(head)
+                if (magic != _SIDECAR_MAGIC or version != _SIDECAR_VERSION or size != stat.st_size
+                        or mtime != stat.st_mtime_ns or content_offset != self._content_offset):
+                    return False
+                offsets, sizes, counts = array.array("q"), array.array("q"), array.array("q")
+                offsets.fromfile(fh, nentries)
+                sizes.fromfile(fh, nentries)
+                counts.fromfile(fh, ndirs)
+                roots = fh.read(len_dirs).decode("utf-8").split("\n")
+                names = fh.read(len_names).decode("utf-8").split("\n") if nentries else list()
+        except (OSError, EOFError, ValueError, struct.error):
+            return False
+        if sys.byteorder != "little":
+            offsets.byteswap()
+            sizes.byteswap()
+            counts.byteswap()
+        nodes, start = dict(), 0
+        for root, count in zip(roots, counts):
+            stop = start + count
+            nodes[root] = _DirNode(tuple(names[start:stop]), offsets[start:stop], sizes[start:stop])
+            start = stop
+        self._files = _CompactFileIndex(nodes)
+        self._dirs = {root: node.names for root, node in nodes.items()}
+        self._headers = None
+        return True
+
+    def _save_sidecar(self, path):
+        """Saves the index to a sidecar file. Errors (e.g. read-only shares) are ignored.
+
+        Must be called while the index is the dictionary built by ``_build_index``.
+        """
+        stat = os.fstat(self._fh.fileno())
+        offsets, sizes, counts = array.array("q"), array.array("q"), array.array("q")
+        names = list()
+        for root, entries in self._dirs.items():
+            counts.append(len(entries))
+            for name in entries:
+                child = f"{root}/{name}" if root else name
+                if child in self._dirs:
+                    offset, size = -1, -1
+                else:
+                    offset, size = self._files.get(child, (-2, 0))
+                offsets.append(offset)
+                sizes.append(size)
+                names.append(name)
+        if sys.byteorder != "little":
+            offsets.byteswap()
+            sizes.byteswap()
+            counts.byteswap()
+        dir_data = "\n".join(self._dirs.keys()).encode("utf-8")
+        name_data = "\n".join(names).encode("utf-8")
+        head = _SIDECAR_HEAD.pack(_SIDECAR_MAGIC, _SIDECAR_VERSION, stat.st_size, stat.st_mtime_ns,
+                                  self._content_offset, len(counts), len(names), len(dir_data),
+                                  len(name_data))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as fh:
+                fh.write(head)
+                offsets.tofile(fh)
+                sizes.tofile(fh)
+                counts.tofile(fh)
+                fh.write(dir_data)
+                fh.write(name_data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _build_index(self):
+        """Builds the flat path index of the header data."""
+        files, dirs = dict(), dict()
+        parents = [("", self.headers["files"])]
+        while parents:
+            root, parent = parents.pop()
+            dirs[root] = tuple(parent.keys())
+            for name, item in parent.items():
+                path = f"{root}/{name}" if root else name
+                if "files" in item:
+                    parents.append((path, item["files"]))
+                elif "offset" in item:
+                    files[path] = (int(item["offset"]), int(item["size"]))
+        self._files = files
+        self._dirs = dirs
+
+    def _get_entry(self, path):
+        """Returns the offset and size of a file in the Asar archive content."""
+        try:
+            return self._files[_normpath(path)]
+        except KeyError:
+            raise AsarFileHeaderError(f"Could not read file '{path}': no offset found")
+
+    def _read_range(self, offset, size):
+        """Reads ``size`` bytes starting at ``offset`` in the Asar file content.
+
+        The shared file pointer is not used, so this is safe to call from multiple
+        threads.
+        """
+        start = self._content_offset + offset
+        if self._mm is not None:
+            return self._view[start:start + size]
+        if hasattr(os, "pread"):
+            fd = self._fh.fileno()
+            data = os.pread(fd, size, start)
+            while len(data) < size:
+                chunk = os.pread(fd, size - len(data), start + len(data))
+                if not chunk:
+                    break
+                data += chunk
+            return data
+        with self._lock:
+            self._fh.seek(start)
+            return self._fh.read(size)
 
     def __enter__(self):
         return self
@@ -221,14 +627,14 @@ class AsarFile:
         {'offset': 12345, 'size': 100}
 
         """
+        path = _normpath(path)
+        if self._headers is None:
+            # Compact index: build the requested section instead of parsing the header
+            item = self._header_from_index(path)
+            return item if keep_files else item.get("files", item)
         if not path:
             return self.headers if keep_files else self.headers["files"]
-        root, name = os.path.split(path)
-        keys = [name]
-        while root:
-            root, name = os.path.split(root)
-            keys.append(name)
-        keys = keys[::-1]
+        keys = path.split("/")
         parent = self.headers["files"]
         for key in keys[:-1]:
             parent = parent[key]["files"]
@@ -237,6 +643,21 @@ class AsarFile:
             return item
         return item.get("files", item)
 
+    def _header_from_index(self, key):
+        """Builds the header data of an entry from the index."""
+        names = self._dirs.get(key)
+        if names is None:
+            offset, size = self._files[key]
+            return {"size": size, "offset": str(offset)}
+        files = dict()
+        for name in names:
+            child = f"{key}/{name}" if key else name
+            try:
+                files[name] = self._header_from_index(child)
+            except KeyError:
+                files[name] = dict()  # Entry without data in the archive
+        return {"files": files}
+
     def walk(self, root_path=""):
         """Generates the file and directory names in a directory in the Asar archive.
 
@@ -264,16 +685,18 @@ class AsarFile:
         ...         for name in filenames:
         ...             file_path = os.path.join(root, name)
         """
-        root_item = self.get_header(root_path)
-        parents = [(root_path, root_item)]
+        if not self.isdir(root_path):
+            raise KeyError(root_path)
+        parents = [(root_path, _normpath(root_path))]
         while parents:
             new_parents = list()
-            for root, parent in parents:
+            for root, key in parents:
                 dirs, files = list(), list()
-                for name, content in parent.items():
-                    if "files" in content:
+                for name in self._dirs[key]:
+                    path = f"{key}/{name}" if key else name
+                    if path in self._dirs:
                         dirs.append(name)
-                        new_parents.append((os.path.join(root, name), content["files"]))
+                        new_parents.append((os.path.join(root, name), path))
                     else:
                         files.append(name)
                 yield root, dirs, files
@@ -316,7 +739,7 @@ class AsarFile:
 
         Returns
         -------
-        names : list[str]
+        names : tuple[str]
             The names of the entries in ``root``.
 
         Examples
@@ -325,8 +748,38 @@ class AsarFile:
         ...     for name in asar.listdir("folder"):
         ...         path = os.path.join("folder", name)
         """
-        parent = self.get_header(root)
-        return list(parent.keys())
+        try:
+            return self._dirs[_normpath(root)]
+        except KeyError:
+            raise KeyError(root) from None
+
+    def isfile(self, path):
+        """Returns True if ``path`` is a file with data in the Asar archive.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file in the archive.
+
+        Returns
+        -------
+        isfile : bool
+        """
+        return _normpath(path) in self._files
+
+    def isdir(self, path):
+        """Returns True if ``path`` is a directory in the Asar archive.
+
+        Parameters
+        ----------
+        path : str
+            The path of the directory in the archive.
+
+        Returns
+        -------
+        isdir : bool
+        """
+        return _normpath(path) in self._dirs
 
     def read_file(self, path, decode=True, encoding=None):
         """Reads the data of a file contained in the Asar archive.
@@ -343,23 +796,149 @@ class AsarFile:
 
         Returns
         -------
-        data : str or bytes
+        data : str or bytes or memoryview
             The data read from the Asar file content. Either a string if ``decode=True``
-            or the raw bytes.
+            or the raw bytes. If the archive is memory-mapped and ``decode=False`` a
+            read-only ``memoryview`` of the mapped content is returned without copying.
 
         Examples
         --------
         >>> with AsarFile("file.asar") as asar
         ...     data = asar.read_file("folder/file.txt")
         """
-        header = self.get_header(path)
-        try:
-            offset = int(header["offset"])
-            size = int(header["size"])
-        except KeyError as e:
-            raise AsarFileHeaderError(f"Could not read file '{path}': {e}")
-        self.seek(offset)
-        return self.read(size, decode, encoding)
+        offset, size = self._get_entry(path)
+        data = self._read_range(offset, size)
+        if decode:
+            data = str(data, encoding or self.encoding)
+        return data
+
+    def read_many(self, paths, decode=True, encoding=None, max_gap=65536,
+                  max_chunk=16777216):
+        """Reads the data of multiple files contained in the Asar archive.
+
+        The requested entries are sorted by their offset in the archive and
+        neighbouring entries are merged into a few large reads, which is much faster
+        than reading them one by one on slow or networked storage.
+
+        Parameters
+        ----------
+        paths : Sequence[str]
+            The paths of the files in the archive to read.
+        decode : bool, optional
+            If True, the bytes read from the files are decoded.
+        encoding : str, optional
+            Encoding used if ``decode=True``. If not passed the instance encoding is
+            used.
+        max_gap : int, optional
+            The maximal number of unused bytes between two entries that are still
+            merged into the same read. The default is 64 KiB.
+        max_chunk : int, optional
+            The maximal number of bytes of a single merged read. Entries larger than
+            this are read on their own. The default is 16 MiB.
+
+        Returns
+        -------
+        data : list[str or memoryview]
+            The data of the files in the same order as ``paths``. Either strings if
+            ``decode=True`` or read-only ``memoryview`` slices of the merged reads.
+
+        Examples
+        --------
+        >>> with AsarFile("file.asar") as asar
+        ...     data1, data2 = asar.read_many(["file1.txt", "folder/file.txt"])
+        """
+        entries = [self._get_entry(path) for path in paths]
+        order = sorted(range(len(entries)), key=lambda i: entries[i][0])
+        results = [None] * len(entries)
+
+        # Group the entries into runs of (almost) contiguous byte ranges
+        groups = list()
+        start, end, group = 0, 0, list()
+        for i in order:
+            offset, size = entries[i]
+            stop = max(end, offset + size)
+            if group and offset - end <= max_gap and stop - start <= max_chunk:
+                end = stop
+                group.append(i)
+            else:
+                if group:
+                    groups.append((start, end, group))
+                start, end, group = offset, offset + size, [i]
+        if group:
+            groups.append((start, end, group))
+
+        for start, end, group in groups:
+            buffer = memoryview(self._read_range(start, end - start))
+            for i in group:
+                offset, size = entries[i]
+                data = buffer[offset - start:offset - start + size]
+                if decode:
+                    data = str(data, encoding or self.encoding)
+                results[i] = data
+        return results
+
+    async def read_file_async(self, path, decode=True, encoding=None, executor=None):
+        """Reads the data of a file contained in the Asar archive without blocking.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file in the archive to read.
+        decode : bool, optional
+            If True, the bytes read from the file are decoded.
+        encoding : str, optional
+            Encoding used if ``decode=True``. If not passed the instance encoding is
+            used.
+        executor : concurrent.futures.Executor, optional
+            The executor running the read. By default, a bounded thread pool shared
+            by all archives is used.
+
+        Returns
+        -------
+        data : str or bytes or memoryview
+            The data read from the Asar file content, see ``read_file``.
+
+        Examples
+        --------
+        >>> async def handler(asar):
+        ...     return await asar.read_file_async("folder/file.txt")
+        """
+        loop = asyncio.get_running_loop()
+        func = functools.partial(self.read_file, path, decode, encoding)
+        return await loop.run_in_executor(executor or _get_async_executor(), func)
+
+    async def read_many_async(self, paths, decode=True, encoding=None, executor=None,
+                              **kwargs):
+        """Reads the data of multiple files contained in the Asar archive without blocking.
+
+        Parameters
+        ----------
+        paths : Sequence[str]
+            The paths of the files in the archive to read.
+        decode : bool, optional
+            If True, the bytes read from the files are decoded.
+        encoding : str, optional
+            Encoding used if ``decode=True``. If not passed the instance encoding is
+            used.
+        executor : concurrent.futures.Executor, optional
+            The executor running the reads. By default, a bounded thread pool shared
+            by all archives is used.
+        **kwargs
+            Additional keyword arguments passed to ``read_many``.
+
+        Returns
+        -------
+        data : list[str or memoryview]
+            The data of the files in the same order as ``paths``, see ``read_many``.
+
+        Examples
+        --------
+        >>> async def handler(asar):
+        ...     return await asar.read_many_async(["file1.txt", "folder/file.txt"])
+        """
+        loop = asyncio.get_running_loop()
+        func = functools.partial(self.read_many, paths, decode, encoding, **kwargs)
+        return await loop.run_in_executor(executor or _get_async_executor(), func)
 
     def extract_file(self, path, dst=""):
         """Extracts a file from the Asar archive and saves it in the given directory.
@@ -382,15 +961,25 @@ class AsarFile:
         >>> with AsarFile("file.asar") as asar
         ...     asar.extract_file("folder/file.txt", dst="asar_contents")
         """
-        data = self.read_file(path, decode=False)
+        offset, size = self._get_entry(path)
         if not os.path.exists(dst):
-            os.makedirs(dst)
-        dst_path = os.path.join(dst, os.path.split(path)[1])
-        with open(dst_path, "wb") as fh:
-            fh.write(data)
+            os.makedirs(dst, exist_ok=True)
+        dst_path = os.path.join(dst, os.path.split(_normpath(path))[1])
+        self._copy_to_file(offset, size, dst_path)
         return dst_path
 
-    def extract(self, root="", dst="asar_contents"):
+    def _copy_to_file(self, offset, size, dst_path):
+        """Writes a byte range of the Asar file content to a new file."""
+        # Unbuffered, so that kernel copies and writes share the same file position
+        with open(dst_path, "wb", buffering=0) as fh:
+            copied = 0
+            if self._mm is None:
+                start = self._content_offset + offset
+                copied = _kernel_copy(self._fh.fileno(), fh.fileno(), start, size)
+            if copied < size:
+                fh.write(self._read_range(offset + copied, size - copied))
+
+    def extract(self, root="", dst="asar_contents", workers=None):
         """Extracts a directory from the archive and saves it in the given directory.
 
         Parameters
@@ -401,6 +990,10 @@ class AsarFile:
         dst : str, optional
             The path of the directory on the system in which the files are saved.
             If the directory does not exist it will be created.
+        workers : int, optional
+            The number of threads used to write the files. If not given the default
+            of ``concurrent.futures.ThreadPoolExecutor`` is used. Pass ``workers=1``
+            to extract the files sequentially.
 
         Returns
         -------
@@ -419,20 +1012,36 @@ class AsarFile:
         >>> with AsarFile("file.asar") as asar
         ...     asar.extract(dst="asar_contents")
         """
-        errors = list()
+        # Create the directory tree once, then copy the file data in parallel
+        jobs = list()
         for _root, files in self.walk_files(root):
             dst_dir = os.path.join(dst, _root)
+            os.makedirs(dst_dir, exist_ok=True)
             for name in files:
-                try:
-                    self.extract_file(os.path.join(_root, name), dst=dst_dir)
-                except AsarFileHeaderError as e:
-                    errors.append(e)
+                jobs.append((os.path.join(_root, name), os.path.join(dst_dir, name)))
+
+        def extract_job(job):
+            path, dst_path = job
+            try:
+                offset, size = self._get_entry(path)
+            except AsarFileHeaderError as e:
+                return e
+            self._copy_to_file(offset, size, dst_path)
+            return None
+
+        if workers == 1:
+            results = map(extract_job, jobs)
+            errors = [e for e in results if e is not None]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(extract_job, jobs)
+                errors = [e for e in results if e is not None]
         return errors
 
     def __repr__(self):
         return f"{self.__class__.__name__}()"
 
-    def _treestr(self, lvl, name, item, indent, depth):
+    def _treestr(self, lvl, name, key, indent, depth):
         vline = "│" + " " * max(indent - 1, 1)
         hline = "├" + "─" * max(indent - 2, 0) + " "
         if lvl == 0:
@@ -440,9 +1049,9 @@ class AsarFile:
         else:
             s = vline * (lvl - 1) + f"{hline}{name}\n"
         if depth is None or lvl < depth:
-            if "files" in item:
-                for key, val in item["files"].items():
-                    s += self._treestr(lvl + 1, key, val, indent, depth)
+            for child in self._dirs.get(key, ()):
+                path = f"{key}/{child}" if key else child
+                s += self._treestr(lvl + 1, child, path, indent, depth)
         return s
 
     def treestr(self, root="", indent=3, depth=None):
@@ -473,7 +1082,467 @@ class AsarFile:
         ├─ folder
         │  ├─ file.txt
         """
+        if not (self.isdir(root) or self.isfile(root)):
+            raise KeyError(root)
         lvl = 0
         name = root or self.__class__.__name__
-        item = self.get_header(root, keep_files=True)
-        return self._treestr(lvl, name, item, indent, depth)
+        return self._treestr(lvl, name, _normpath(root), indent, depth)
+
+
+class AsarFilePool:
+    """Least-recently-used pool of open Asar archives.
+
+    Archives are keyed by their absolute path and reopened if the file was modified
+    (size or modification time changed) since it was opened. If more than
+    ``maxsize`` archives are open, the least recently used one is dropped from the
+    pool. A dropped archive is closed as soon as no caller references it anymore,
+    so archives returned by ``get`` stay usable while they are in use.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximal number of archives kept open. The default is 8.
+    **kwargs
+        Keyword arguments passed to ``AsarFile`` when opening an archive, for
+        example ``use_mmap=True``.
+
+    Notes
+    -----
+    The pool is thread-safe. Archives returned by ``get`` must not be closed by the
+    caller, use ``close_all`` to release all open files instead.
+
+    Examples
+    --------
+    >>> pool = AsarFilePool(maxsize=4, use_mmap=True)
+    >>> data = pool.get("file.asar").read_file("folder/file.txt")
+    >>> pool.close_all()
+    """
+
+    def __init__(self, maxsize=8, **kwargs):
+        self.maxsize = maxsize
+        self._kwargs = kwargs
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, file):
+        return os.path.abspath(file) in self._files
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(maxsize={self.maxsize}, open={len(self)})"
+
+    def get(self, file, **kwargs):
+        """Returns the open archive of ``file``, opening it if necessary.
+
+        Parameters
+        ----------
+        file : str
+            The file path of the Asar file.
+        **kwargs
+            Keyword arguments overriding those of the pool if the archive has to be
+            opened. They are ignored if the archive is already open.
+
+        Returns
+        -------
+        asar : AsarFile
+            The open archive. It is shared with other users of the pool.
+        """
+        key = os.path.abspath(file)
+        stat = os.stat(key)
+        version = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            item = self._files.get(key)
+            if item is not None:
+                if item[0] == version:
+                    self._files.move_to_end(key)
+                    return item[1]
+                del self._files[key]
+        # Open the archive outside the lock, parsing the header may take a while
+        asar = AsarFile(key, **{**self._kwargs, **kwargs})
+        with self._lock:
+            self._files[key] = (version, asar)
+            self._files.move_to_end(key)
+            while len(self._files) > self.maxsize:
+                self._files.popitem(last=False)
+        return asar
+
+    def close(self, file):
+        """Closes the archive of ``file`` and removes it from the pool, if it is open.
+
+        Parameters
+        ----------
+        file : str
+            The file path of the Asar file.
+        """
+        with self._lock:
+            item = self._files.pop(os.path.abspath(file), None)
+        if item is not None:
+            item[1].close()
+
+    def close_all(self):
+        """Closes all archives of the pool and clears it."""
+        with self._lock:
+            items = list(self._files.values())
+            self._files.clear()
+        for _, asar in items:
+            asar.close()
+
+
+class AsarWriter:
+    """Electron Asar archive writer.
+
+    Entries can be added from bytes, from files on the system or from another open
+    ``AsarFile``. Nothing is written to the output until ``close`` is called: the
+    header is built from the collected entries and the content section is then
+    streamed to the output file in the order of the header. Data added as bytes is
+    spooled to a temporary file, so memory usage does not grow with the archive.
+
+    Parameters
+    ----------
+    file : str
+        The file path of the Asar archive to create.
+    encoding : str, optional
+        The encoding of the Asar archive header. The default is platform specific.
+    dedup : bool, optional
+        If True, entries with identical content are stored only once and their
+        header entries share the same offset. The number of bytes saved is available
+        as ``bytes_saved`` after ``close``. The default is False.
+
+    Notes
+    -----
+    Like ``asar pack``, the entries of each directory are sorted by name. Source
+    ``AsarFile`` instances must stay open until the writer is closed. The archive
+    is written to a temporary file next to ``file`` and renamed to ``file`` once it
+    is complete, so no partial archive is left behind if writing fails. If the
+    ``with`` block is left with an exception, no output file is written.
+
+    With ``dedup`` only entries whose size occurs more than once are hashed, and
+    entries pointing at the same data of a source archive are merged without reading
+    them. Asar readers resolve each entry by offset and size only, so shared data is
+    transparent to them.
+
+    Examples
+    --------
+    Pack the contents of a directory:
+
+    >>> with AsarWriter("file.asar") as asar
+    ...     asar.add_dir("asar_contents")
+
+    Copy a directory of another archive under a new name and add a file:
+
+    >>> with AsarFile("src.asar") as src, AsarWriter("file.asar") as asar
+    ...     asar.add_asar(src, "folder", dst_root="renamed")
+    ...     asar.add_bytes("info.txt", b"copied from src.asar")
+    """
+
+    def __init__(self, file, encoding=None, dedup=False):
+        self._file = file
+        self._encoding = encoding or ENCODING
+        self._dedup = dedup
+        self._entries = dict()
+        self._dirs = set()
+        self._spool = None
+        self.bytes_saved = 0
+
+    @property
+    def encoding(self):
+        """str: The encoding of the Asar file header."""
+        return self._encoding
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self._file!r})"
+
+    def _add(self, path, source):
+        path = _normpath(path)
+        if not path:
+            raise ValueError("The path of a file in the archive can not be empty")
+        if path in self._dirs:
+            raise ValueError(f"Can not add file '{path}': it is a directory")
+        root = os.path.dirname(path)
+        while root:
+            if root in self._entries:
+                raise ValueError(f"Can not add file '{path}': '{root}' is a file")
+            self._dirs.add(root)
+            root = os.path.dirname(root)
+        self._entries[path] = source
+
+    def add_bytes(self, path, data):
+        """Adds a file with the given content to the archive.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file in the archive.
+        data : bytes or str
+            The file content. Strings are encoded with the archive encoding.
+        """
+        if isinstance(data, str):
+            data = data.encode(self._encoding)
+        if self._spool is None:
+            self._spool = tempfile.TemporaryFile()
+        offset = self._spool.seek(0, os.SEEK_END)
+        self._spool.write(data)
+        self._add(path, ("spool", None, offset, len(data)))
+
+    def add_file(self, path, src):
+        """Adds a file on the system to the archive.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file in the archive.
+        src : str
+            The path of the file on the system. It is read when the writer is closed.
+        """
+        self._add(path, ("file", src, 0, os.path.getsize(src)))
+
+    def add_dir(self, src_dir, root=""):
+        """Adds the contents of a directory on the system to the archive.
+
+        Parameters
+        ----------
+        src_dir : str
+            The path of the directory on the system.
+        root : str, optional
+            The path of the directory in the archive the contents are added to. By
+            default, the contents are added to the archive root.
+        """
+        root = _normpath(root)
+        for dirpath, dirnames, filenames in os.walk(src_dir):
+            rel = _normpath(os.path.relpath(dirpath, src_dir))
+            rel = "" if rel == "." else rel
+            parent = "/".join(p for p in (root, rel) if p)
+            for name in dirnames:
+                self._dirs.add(f"{parent}/{name}" if parent else name)
+            for name in filenames:
+                path = f"{parent}/{name}" if parent else name
+                self.add_file(path, os.path.join(dirpath, name))
+
+    def add_asar(self, asar, root="", dst_root=None):
+        """Adds a file or directory of an open Asar archive without extracting it.
+
+        Parameters
+        ----------
+        asar : AsarFile
+            The open source archive. It must stay open until the writer is closed.
+        root : str, optional
+            The path of the file or directory in the source archive. By default, the
+            whole archive is added.
+        dst_root : str, optional
+            The path in this archive the entry is added as. By default, ``root`` is
+            used.
+
+        Raises
+        ------
+        ValueError
+            If ``asar`` is the file this writer creates.
+        """
+        if (asar._fh is not None and os.path.exists(self._file)
+                and os.path.samestat(os.fstat(asar._fh.fileno()), os.stat(self._file))):
+            raise ValueError(f"Can not add '{self._file}' to itself, write to another file")
+        root = _normpath(root)
+        dst_root = root if dst_root is None else _normpath(dst_root)
+        if asar.isfile(root):
+            offset, size = asar._get_entry(root)
+            self._add(dst_root, ("asar", asar, offset, size))
+            return
+        for _root, dirs, files in asar.walk(root):
+            rel = _normpath(_root)[len(root):].strip("/")
+            parent = "/".join(p for p in (dst_root, rel) if p)
+            for name in dirs:
+                self._dirs.add(f"{parent}/{name}" if parent else name)
+            for name in files:
+                src_path = f"{_normpath(_root)}/{name}" if _root else name
+                if asar.isfile(src_path):
+                    offset, size = asar._get_entry(src_path)
+                    path = f"{parent}/{name}" if parent else name
+                    self._add(path, ("asar", asar, offset, size))
+
+    def _iter_source(self, source, chunk_size=16777216):
+        """Yields the data of a single entry in chunks."""
+        kind, src, offset, size = source
+        for start in range(offset, offset + size, chunk_size):
+            n = min(chunk_size, offset + size - start)
+            if kind == "asar":
+                yield src._read_range(start, n)
+            elif kind == "spool":
+                self._spool.seek(start)
+                yield self._spool.read(n)
+            else:
+                with open(src, "rb") as fh:
+                    fh.seek(start)
+                    yield fh.read(n)
+
+    def _content_keys(self):
+        """Returns a key per entry path, entries with the same key have identical data."""
+        # Entries pointing at the same data of the same source are identical
+        locations = dict()
+        for path, (kind, src, offset, size) in self._entries.items():
+            locations[path] = (kind, id(src) if kind == "asar" else src, offset, size)
+        by_size = dict()
+        for path, location in locations.items():
+            by_size.setdefault(location[3], dict()).setdefault(location, path)
+        # Only data that could have a duplicate of the same size is hashed
+        digests = dict()
+        for size, unique in by_size.items():
+            if len(unique) < 2:
+                continue
+            for location, path in unique.items():
+                digest = hashlib.blake2b(digest_size=20)
+                for chunk in self._iter_source(self._entries[path]):
+                    digest.update(chunk)
+                digests[location] = (size, digest.digest())
+        return {path: digests.get(location, location) for path, location in locations.items()}
+
+    def _build_header(self):
+        """Returns the header data and the entries in content order."""
+        tree = dict()
+        for path in self._dirs:
+            node = tree
+            for key in path.split("/"):
+                node = node.setdefault(key, dict())
+        for path in self._entries:
+            node = tree
+            *keys, name = path.split("/")
+            for key in keys:
+                node = node.setdefault(key, dict())
+            node[name] = path
+
+        order = list()
+        offset = 0
+        keys = self._content_keys() if self._dedup else None
+        stored = dict()
+        self.bytes_saved = 0
+
+        def build(node):
+            nonlocal offset
+            files = dict()
+            for name in sorted(node):
+                item = node[name]
+                if isinstance(item, dict):
+                    files[name] = {"files": build(item)}
+                    continue
+                size = self._entries[item][3]
+                if keys is not None and keys[item] in stored:
+                    # Identical data was already stored, share its offset
+                    files[name] = {"size": size, "offset": str(stored[keys[item]])}
+                    self.bytes_saved += size
+                    continue
+                if keys is not None:
+                    stored[keys[item]] = offset
+                files[name] = {"size": size, "offset": str(offset)}
+                order.append(self._entries[item])
+                offset += size
+            return files
+
+        return {"files": build(tree)}, order
+
+    def _copy_source(self, fh, source):
+        """Streams the data of a single entry to the output file handler."""
+        kind, src, offset, size = source
+        if kind == "asar":
+            if src.mmapped:
+                fh.write(src._read_range(offset, size))
+                return
+            copied = _kernel_copy(src._fh.fileno(), fh.fileno(), src._content_offset + offset, size)
+            if copied < size:
+                fh.write(src._read_range(offset + copied, size - copied))
+            return
+        src_fh = self._spool if kind == "spool" else open(src, "rb")
+        try:
+            copied = _kernel_copy(src_fh.fileno(), fh.fileno(), offset, size)
+            src_fh.seek(offset + copied)
+            while copied < size:
+                chunk = src_fh.read(min(size - copied, 16777216))
+                if not chunk:
+                    raise OSError(f"Unexpected end of file while reading '{src}'")
+                fh.write(chunk)
+                copied += len(chunk)
+        finally:
+            if kind != "spool":
+                src_fh.close()
+
+    def close(self):
+        """Writes the Asar archive and releases the temporary data.
+
+        Returns
+        -------
+        file_path : str
+            The file path of the written Asar archive.
+        """
+        if self._entries is None:
+            return self._file
+        headers, order = self._build_header()
+        if self._spool is not None:
+            self._spool.flush()
+
+        # The header is stored with Google's pickle format, see ``AsarFile.open``
+        header_data = json.dumps(headers, separators=(",", ":")).encode(self._encoding)
+        padding = b"\x00" * (-len(header_data) % 4)
+        header_pickle = struct.pack("<II", 4 + len(header_data) + len(padding), len(header_data))
+        header_pickle += header_data + padding
+        tmp_file = f"{self._file}.{os.getpid()}.tmp"
+        try:
+            # Unbuffered, so that kernel copies and writes share the same file position
+            with open(tmp_file, "wb", buffering=0) as fh:
+                fh.write(struct.pack("<II", 4, len(header_pickle)) + header_pickle)
+                for source in order:
+                    self._copy_source(fh, source)
+            os.replace(tmp_file, self._file)
+        except BaseException:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            raise
+        finally:
+            self.abort()
+        return self._file
+
+    def abort(self):
+        """Discards all added entries without writing the Asar archive."""
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        self._entries = None
+        self._dirs = None
+
+
+def pack(src_dir, file, encoding=None, dedup=False):
+    """Packs the contents of a directory into a new Asar archive.
+
+    Parameters
+    ----------
+    src_dir : str
+        The path of the directory on the system to pack.
+    file : str
+        The file path of the Asar archive to create.
+    encoding : str, optional
+        The encoding of the Asar archive header. The default is platform specific.
+    dedup : bool, optional
+        If True, files with identical content are stored only once, see
+        ``AsarWriter``. The default is False.
+
+    Returns
+    -------
+    file_path : str
+        The file path of the written Asar archive.
+
+    Examples
+    --------
+    >>> pack("asar_contents", "file.asar")
+    """
+    with AsarWriter(file, encoding, dedup=dedup) as asar:
+        asar.add_dir(src_dir)
+    return file
@@ -0,0 +1,136 @@
+################################################################################
+# benchmarks for .med (asar) reading/cropping
+#
+#   results are printed, redirect to bench_output.txt if needs
+################################################################################
+import os
+import time
+import tracemalloc
+import asarlib
+
+## create a synthetic .med-like archive with tiny tiles, for benchmarks only
+def makeSyntheticMED(medfname, nentries=1000000, zlayers=1, tilesize=1):
+    perlayer = nentries // zlayers
+    cols = max(int(perlayer ** 0.5), 1)
+    tile = b'\x00' * tilesize
+    with asarlib.AsarWriter(medfname) as packmed:
+        packmed.add_bytes('metadata.json', '{"SizeZ": %d}' % zlayers)
+        for z in range(zlayers):
+            packmed.add_bytes(f'Z{z}.dzi', b'<Image/>')
+            for i in range(perlayer):
+                packmed.add_bytes(f'Z{z}_files/17/{i % cols}_{i // cols}.webp', tile)
+    return medfname
+
+## memory usage of an open archive: nested JSON header vs compact index vs sidecar index
+def benchAsarIndexMemory(workpath, nentries=1000000):
+    medfname = os.path.join(workpath, f'synthetic_{nentries}.med')
+    if not os.path.isfile(medfname):
+        print(f'[INFO] creating synthetic archive with {nentries} entries...')
+        makeSyntheticMED(medfname, nentries)
+    sidecar = f'{medfname}idx'
+    if os.path.isfile(sidecar):
+        os.remove(sidecar)
+    asarlib.AsarFile(medfname, sidecar=True).close()    ## write the sidecar index once
+    results = []
+    for label, kwargs in [('json header', {}), ('compact', {'compact': True}), ('sidecar', {'sidecar': True})]:
+        tsfrom = time.perf_counter()
+        asarlib.AsarFile(medfname, **kwargs).close()
+        opentime = time.perf_counter() - tsfrom
+        ## tracemalloc slows down the allocations, so the open time is measured without it
+        tracemalloc.start()
+        thismed = asarlib.AsarFile(medfname, **kwargs)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        thismed.close()
+        results.append((label, current / 2**20, peak / 2**20, opentime))
+    print(f'{"index":<12} {"resident(MB)":>13} {"peak(MB)":>10} {"open(s)":>8}')
+    for label, current, peak, opentime in results:
+        print(f'{label:<12} {current:>13.1f} {peak:>10.1f} {opentime:>8.3f}')
+    return results
+
+## throughput of concurrent tile requests against one open .med file (asyncio)
+def benchAsyncTileReads(workpath, nrequests=100, rounds=20, tilesize=20000, use_mmap=False):
+    import asyncio
+    import random
+    medfname = os.path.join(workpath, f'synthetic_tiles_{tilesize}.med')
+    if not os.path.isfile(medfname):
+        with asarlib.AsarWriter(medfname) as packmed:
+            for i in range(4096):
+                packmed.add_bytes(f'Z0_files/17/{i % 64}_{i // 64}.webp', os.urandom(tilesize))
+    thismed = asarlib.AsarFile(medfname, use_mmap=use_mmap)
+    webplist = [f'Z0_files/17/{name}' for name in thismed.listdir('Z0_files/17')]
+    requests = [random.sample(webplist, nrequests) for _ in range(rounds)]
+    ## blocking reads, one after the other
+    tsfrom = time.perf_counter()
+    for paths in requests:
+        for path in paths:
+            thismed.read_file(path, decode=False)
+    syncsec = time.perf_counter() - tsfrom
+    ## nrequests reads in flight at the same time
+    async def serveRequests():
+        for paths in requests:
+            await asyncio.gather(*[thismed.read_file_async(path, decode=False) for path in paths])
+    tsfrom = time.perf_counter()
+    asyncio.run(serveRequests())
+    asyncsec = time.perf_counter() - tsfrom
+    thismed.close()
+    total = nrequests * rounds
+    print(f'[INFO] {total} tile reads ({tilesize} bytes, {nrequests} concurrent, mmap={use_mmap})')
+    print(f'{"mode":<8} {"requests/s":>12} {"total(s)":>9}')
+    print(f'{"sync":<8} {total/syncsec:>12.0f} {syncsec:>9.3f}')
+    print(f'{"asyncio":<8} {total/asyncsec:>12.0f} {asyncsec:>9.3f}')
+    return total/syncsec, total/asyncsec
+
+## create a synthetic single-layer .med with real WebP tiles (bottom level only), for benchmarks only
+def makeSyntheticDZIMED(medfname, width=16384, height=16384, quality=80):
+    import io
+    import math
+    import numpy as np
+    from PIL import Image
+    tilesize, overlap = 254, 1
+    level = math.ceil(math.log2(max(width, height)))
+    ## smooth pattern plus noise, so that the tiles decode like tissue rather than blank background
+    yy, xx = np.mgrid[0:tilesize + 2*overlap, 0:tilesize + 2*overlap]
+    rng = np.random.default_rng(0)
+    with asarlib.AsarWriter(medfname) as packmed:
+        packmed.add_bytes('metadata.json', '{"SizeZ": 1, "BestFocusLayer": 0, "Width": %d, "Height": %d}' % (width, height))
+        packmed.add_bytes('Z0.dzi', f'<?xml version="1.0" encoding="UTF-8"?>\n<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"\n'
+                                    f'  Format="webp"\n  Overlap="{overlap}"\n  TileSize="{tilesize}"\n  >\n'
+                                    f'  <Size \n    Height="{height}"\n    Width="{width}"\n  />\n</Image>\n')
+        for col in range(math.ceil(width / tilesize)):
+            for row in range(math.ceil(height / tilesize)):
+                x0, y0 = col*tilesize - (overlap if col > 0 else 0), row*tilesize - (overlap if row > 0 else 0)
+                x1, y1 = min((col+1)*tilesize + overlap, width), min((row+1)*tilesize + overlap, height)
+                base = 128 + 60*np.sin((xx[:y1-y0, :x1-x0] + x0) / 37.0) * np.cos((yy[:y1-y0, :x1-x0] + y0) / 23.0)
+                tile = np.clip(base[..., None] + rng.normal(0, 20, (y1-y0, x1-x0, 3)), 0, 255).astype(np.uint8)
+                buf = io.BytesIO()
+                Image.fromarray(tile).save(buf, 'WEBP', quality=quality)
+                packmed.add_bytes(f'Z0_files/{level}/{col}_{row}.webp', buf.getvalue())
+    return medfname
+
+## serial vs thread-pool tile decoding of square ROIs (tile cache cleared before every read)
+def benchParallelTileDecode(workpath, roisizes=(1000, 4000, 16000), workers=16, rounds=3):
+    import medfuncs as mf
+    slidesize = max(roisizes)
+    medfname = os.path.join(workpath, f'synthetic_dzi_{slidesize}.med')
+    if not os.path.isfile(medfname):
+        print(f'[INFO] creating synthetic {slidesize}x{slidesize} slide...')
+        makeSyntheticDZIMED(medfname, slidesize, slidesize)
+    print(f'[INFO] {os.cpu_count()} CPUs, {workers} decode workers, best of {rounds}')
+    print(f'{"ROI(px)":<10} {"serial(s)":>10} {"parallel(s)":>12} {"speedup":>8}')
+    results = []
+    for roisize in roisizes:
+        timing = []
+        for nworkers in (1, workers):
+            best = None
+            for _ in range(rounds):
+                mf.TILECACHE.clear()
+                tsfrom = time.perf_counter()
+                mf.cropCellFromMEDfile(medfname, 0, 0, roisize, roisize, workers=nworkers)
+                elapsed = time.perf_counter() - tsfrom
+                best = elapsed if best is None else min(best, elapsed)
+            timing.append(best)
+        mf.TILECACHE.clear()
+        print(f'{roisize:<10} {timing[0]:>10.3f} {timing[1]:>12.3f} {timing[0]/timing[1]:>8.2f}')
+        results.append((roisize, timing[0], timing[1]))
+    return results
@@ -18,6 +18,7 @@ import re
 import json
 import qrcode
 import glob
+import asarlib
 import auxfuncs as aux
 
 def isNumeric(unknown):
@@ -186,7 +187,6 @@ def getMRXSproperties(mrxspath, bestzonly, mrxs, iccname, iccsize):
 def convertWSI2MED(wsifname, bestzonly=False):
     args = aux.getConfig()
     exevips = args['exe_vips']
-    exeasar = args['exe_rasar']
     dzipath = os.path.join(args['tempzone'], 'dzi')
     if os.path.isdir(dzipath) == False:
         os.mkdir(dzipath)
@@ -216,8 +216,7 @@ def convertWSI2MED(wsifname, bestzonly=False):
         wsiname = os.path.splitext(os.path.basename(wsifname))[0]
         if bestzonly:
             wsiname = wsiname+'_bestz'
-        asar_cmd = f'{exeasar} pack {dzipath} {os.path.dirname(wsifname)}\\{wsiname}.med'
-        os.system(asar_cmd)
+        asarlib.pack(dzipath, os.path.join(os.path.dirname(wsifname), f'{wsiname}.med'))
         ## remove dzi folder
         shutil.rmtree(dzipath)
     else:
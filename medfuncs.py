@@ -1,10 +1,35 @@
 import os, glob
-import shutil
+import io
 import asarlib
 import json
+import copy
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import auxfuncs as aux
 
+## process-wide pool of open .med files, so that repeated reads of the same slide
+## (metadata, cell crops) do not re-open the file and re-parse its header
+MEDPOOL = asarlib.AsarFilePool(maxsize=16, use_mmap=True, compact=True)
+
+## set USE_SIDECAR = True to cache the index of each opened slide in a {slide}.medidx file next
+## to it, large slides are then reopened without parsing their header (needs write access)
+USE_SIDECAR = False
+
+def openMEDfile(medfname):
+    return MEDPOOL.get(medfname, sidecar=USE_SIDECAR)
+
+## close all .med files kept open by MEDPOOL (e.g. before moving/deleting them)
+def closeAllMEDfiles():
+    MEDSLIDES.clear()
+    MEDPOOL.close_all()
+
+## close a single .med file kept open by MEDSLIDES/MEDPOOL (e.g. before rewriting it in place)
+def closeMEDfile(medfname):
+    with _medslideslock:
+        MEDSLIDES.pop(os.path.abspath(medfname), None)
+    MEDPOOL.close(medfname)
+
 ## retrieve necessary metadata from metadata.json in a .med file
 def readMakerAndDeviceFromMED(medjson):
     maker = medjson.get('Vndor', '')
@@ -19,12 +44,91 @@ def readMakerAndDeviceFromMED(medjson):
         scanner += f' ({medjson["ScannerModel"]})'
     return scanner
 
+## metadata is read once per slide (see MedSlide), callers get their own copy
 def getMetadataFromMED(medfile):
-    with asarlib.AsarFile(medfile) as thismed:
-        mdata = thismed.read_file('metadata.json')
-    metajson = json.loads(mdata)
-    return metajson
+    return copy.deepcopy(openMedSlide(medfile).metadata)
+
+## metadata of all .med files in a folder, read by worker processes, cached on disk
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
+## metadata.json of one .med file for scanMEDMetadata (runs in a worker process)
+def readMEDMetadataEntry(medfname):
+    entry = {'size': -1, 'mtime_ns': -1, 'metadata': None, 'error': ''}
+    try:
+        stat = os.stat(medfname)
+        entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+        with asarlib.AsarFile(medfname) as thismed:
+            entry['metadata'] = json.loads(thismed.read_file('metadata.json'))
+    except Exception as e:
+        entry['error'] = f'{type(e).__name__}: {e}'
+    return medfname, entry
+
+## scan the .med files of a folder into a DataFrame, one row per file: medfname, MPP, Width,
+## Height, SizeZ, BestFocusLayer, scanner, ... (all scalar metadata.json fields)
+##   workers: number of worker processes reading the files that are not cached yet
+##   cachefile: JSON cache of the metadata keyed by path, size and mtime, so that unchanged
+##     files are not opened again; default {folder}/medmetadata.json, '' disables the cache,
+##     a cache which cannot be written (read-only folder) is skipped with a warning
+def scanMEDMetadata(folder, workers=8, recursive=False, cachefile=None):
+    pattern = os.path.join(folder, '**', '*.med') if recursive else os.path.join(folder, '*.med')
+    medlist = sorted(os.path.abspath(medfname) for medfname in glob.glob(pattern, recursive=recursive))
+    cachefile = os.path.join(folder, 'medmetadata.json') if cachefile is None else cachefile
+    cache = {}
+    if cachefile != '' and os.path.isfile(cachefile):
+        try:
+            with open(cachefile, 'r', encoding='utf-8') as cachejson:
+                cache = json.load(cachejson)
+        except (OSError, ValueError):
+            aux.printmsg(f'[WARNING] ignoring unreadable metadata cache {cachefile}')
+    ## files whose size or mtime changed since they were cached are read again
+    pending = []
+    for medfname in medlist:
+        entry = cache.get(medfname)
+        try:
+            stat = os.stat(medfname)
+        except OSError:
+            ## deleted or inaccessible since the glob, readMEDMetadataEntry records the error
+            pending.append(medfname)
+            continue
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns or entry['error'] != '':
+            pending.append(medfname)
+    if len(pending) > 0:
+        aux.printmsg(f'[INFO] reading metadata of {len(pending)} of {len(medlist)} .med files...')
+        if workers > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                entries = list(executor.map(readMEDMetadataEntry, pending, chunksize=max(1, len(pending) // (workers * 4))))
+        else:
+            entries = [readMEDMetadataEntry(medfname) for medfname in pending]
+        cache.update(entries)
+        if cachefile != '':
+            ## entries of files which no longer exist are dropped
+            alive = set(medlist)
+            tmpfile = f'{cachefile}.tmp'
+            try:
+                with open(tmpfile, 'w', encoding='utf-8') as cachejson:
+                    json.dump({medfname: entry for medfname, entry in cache.items() if medfname in alive}, cachejson)
+                os.replace(tmpfile, cachefile)
+            except OSError as e:
+                ## e.g. a read-only slide store, the scan result is returned anyway
+                aux.printmsg(f'[WARNING] cannot write metadata cache {cachefile}: {e}')
+                if os.path.isfile(tmpfile):
+                    os.remove(tmpfile)
+    rows = []
+    for medfname in medlist:
+        entry = cache[medfname]
+        row = {'medfname': medfname, 'filesize': entry['size'], 'error': entry['error']}
+        medjson = entry['metadata'] or {}
+        row.update({key: value for key, value in medjson.items() if not isinstance(value, (list, dict))})
+        try:
+            row['scanner'] = readMakerAndDeviceFromMED(medjson) if len(medjson) > 0 else ''
+        except KeyError:
+            row['scanner'] = ''
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+## write metadata.json of a single layer into an extracted DZI folder, kept as public API for
+## scripts working on extracted folders (runmodel uses splitLayersFromMED instead)
 def updateMEDmetadata2singleLayer(medfile, dzipath):
     medjson = getMetadataFromMED(medfile)
     sizeZ = medjson.get('SizeZ', 1)
@@ -35,19 +139,26 @@ def updateMEDmetadata2singleLayer(medfile, dzipath):
     if bestZ == -1:
         aux.printmsg(f'[ERROR] missing BestFocusLayer in metadata of {os.path.basename(medfile)}', True)
         return sizeZ, 0
-    medjson.pop('BestFocusLayer')
-    levelcount = medjson.get('LevelCount', 0)
-    if levelcount > 0:
-        medjson['LevelCount'] = 0
-    medjson['IndexZ'] = [0]
-    medjson['SizeZ']  = 1
     ## update metadata.json
     metafile = os.path.join(dzipath, 'metadata.json')
     with open(metafile, 'w', encoding='utf-8') as newmeta:
-        json.dump(medjson, newmeta)
+        json.dump(getSingleLayerMetadata(medjson), newmeta)
     aux.printmsg(f'[INFO] metadata.json for single layer was updated')
     return sizeZ, bestZ
 
+## metadata.json of a single layer extracted from a multi-layer .med file
+def getSingleLayerMetadata(medjson):
+    medjson = copy.deepcopy(medjson)
+    medjson.pop('BestFocusLayer', None)
+    levelcount = medjson.get('LevelCount', 0)
+    if levelcount > 0:
+        medjson['LevelCount'] = 0
+    medjson['IndexZ'] = [0]
+    medjson['SizeZ']  = 1
+    return medjson
+
+## extract layer 'layer' and the associated files of a .med file into a DZI folder, kept as public
+## API for scripts working on extracted folders (runmodel uses splitLayersFromMED instead)
 def extractDZIdataFromMED(medfile, layer, dzipath):
     with asarlib.AsarFile(medfile) as thismed:
         ## extract associated file
@@ -85,7 +196,6 @@ def reviseMetadataJson(metafile, workpath, zstack):
 ## pack multiple .med files to be a single .med file
 ##   input: folder containing .med files, number of layers, separation distance,
 ##          original separatio step (defaut: 1um)
-##  [note]: .med file should be unpacked before this processing
 def packMultiLayers2singleMED(medfolder, dstfolder, s_layer, e_layer, step_um):
     medfiles = glob.glob(os.path.join(medfolder, '*.med'))
     if len(medfiles) == 0:
@@ -102,132 +212,96 @@ def packMultiLayers2singleMED(medfolder, dstfolder, s_layer, e_layer, step_um):
     if errmsg != '':
         print(errmsg)
         return    
-    # revise metadata.json from multiple to single .med file
-    dzipath = os.path.join(dstfolder, 'dzi')
-    if os.path.isdir(dzipath) == False:
-        os.mkdir(dzipath)
-    # extract (not webp) files from .med file
-    with asarlib.AsarFile(medfiles[0]) as thismed:
-        asslist = thismed.listdir()
-        for i, associate in enumerate(asslist):
-            if 'Z' not in associate:
-                thismed.extract_file(associate, dst=dzipath)
-    ## revise metadata.json
-    oldmetafile = os.path.join(dzipath, 'metadata.json')
+    # stream associated files (not webp) and layers from the .med files into a single .med file
     zstack = int((e_layer-s_layer)/step_um)+1
-    ##--reviseMetadataJson(oldmetafile, dzipath, zstack)
-    with open(oldmetafile, 'r', encoding='utf-8') as fmeta:
-        metajson = json.load(fmeta)
-    metajson['SizeZ'] = zstack
-    metajson['LevelCount'] = zstack+1
-    metajson['IndexZ'] = [i for i in range(1, zstack+1)]
-    metajson['BestFocusLayer'] = zstack // 2
-    ## save revised metadata.json
-    metafile = os.path.join(dzipath, 'metadata.json')  ## save to workpath, not the original.med file roo
-    with open(metafile, 'w', encoding='utf-8') as newmeta:
-        json.dump(metajson, newmeta)
-    ##
-    zidx = zstack-1
     med_prefix = os.path.splitext(os.path.basename(medfiles[0]))[0][:-2]
-    for i in range(e_layer, s_layer-1, 0-step_um):
-        thismed = f'{medfolder}\\{med_prefix}{i:02}.med'
-        ## retrieve Z0_files and Z0.dzi from.med file
-        with asarlib.AsarFile(thismed) as unpackmed:
-            unpackmed.extract('Z0_files', dzipath)
-            unpackmed.extract_file('Z0.dzi', dzipath)
-        ## rename Z0_files to Z{zidx}_files
-        os.rename(os.path.join(dzipath, 'Z0_files'), os.path.join(dzipath, f'Z{zidx}_files'))
-        ## rename Z0.dzi to Z{zidx}.dzi
-        os.rename(os.path.join(dzipath, 'Z0.dzi'), os.path.join(dzipath, f'Z{zidx}.dzi'))
-        zidx -= 1
-    ## pack all files to a single.med file
-    args = aux.getConfig()
-    rasar = args['exe_rasar']
     medfile = os.path.join(dstfolder, f'{med_prefix[:-2]}-{zstack}L{step_um}um.med')
     print(f'{aux.sNOW()}[INFO] Packing {zstack} .med files to {os.path.basename(medfile)}...')
-    packMED = f'{rasar} pack {dzipath} {medfile}'
-    os.system(packMED)
-    print(f'{aux.sNOW()}[INFO] removing temporary dzi folder...')
-    shutil.rmtree(dzipath)
+    srcmeds = []
+    with asarlib.AsarWriter(medfile) as packmed:
+        firstmed = asarlib.AsarFile(medfiles[0])
+        srcmeds.append(firstmed)
+        for associate in firstmed.listdir():
+            if 'Z' not in associate and associate != 'metadata.json':
+                packmed.add_asar(firstmed, associate)
+        ## revise metadata.json
+        metajson = json.loads(firstmed.read_file('metadata.json'))
+        metajson['SizeZ'] = zstack
+        metajson['LevelCount'] = zstack+1
+        metajson['IndexZ'] = [i for i in range(1, zstack+1)]
+        metajson['BestFocusLayer'] = zstack // 2
+        packmed.add_bytes('metadata.json', json.dumps(metajson))
+        ##
+        zidx = zstack-1
+        for i in range(e_layer, s_layer-1, 0-step_um):
+            thismed = os.path.join(medfolder, f'{med_prefix}{i:02}.med')
+            ## Z0_files and Z0.dzi of this .med file become Z{zidx}_files and Z{zidx}.dzi
+            unpackmed = asarlib.AsarFile(thismed)
+            srcmeds.append(unpackmed)
+            packmed.add_asar(unpackmed, 'Z0_files', f'Z{zidx}_files')
+            packmed.add_asar(unpackmed, 'Z0.dzi', f'Z{zidx}.dzi')
+            zidx -= 1
+    for unpackmed in srcmeds:
+        unpackmed.close()
     print(f'{aux.sNOW()}[INFO] {os.path.basename(medfile)} completed!')
 
 ## extract partial layers of images, then pack to a single.med file 
 def extractPartialLayers2singleMED(medfname, dstfolder, s_layer, e_layer, step_um):
-    ## parameters settings
-    args = aux.getConfig()
-    #dzi_tmp = os.path.join(dstfolder 'dzi')
-    rasar = args['exe_rasar']
     ## replace ' ' with '_' in the .med filename
     thismed = aux.replaceSpace2underscore(medfname)
-    dzi_tmp = os.path.join(dstfolder, 'dzi')
-    if not os.path.exists(dzi_tmp):
-        os.mkdir(dzi_tmp)
-    ## extraact necessary files/folders from .med, using asarlib
+    ## stream necessary files/folders from .med to the new .med, using asarlib
     if (e_layer-s_layer) % step_um != 0:
         print(f'{aux.sNOW()}[ERROR] The number of layers is not a multiple of the step size.')
         return
     zstack = int((e_layer-s_layer)/step_um) + 1
+    medprefixname = os.path.splitext(os.path.basename(thismed))[0]
+    medfname = os.path.join(dstfolder, f'{medprefixname}-{zstack}L{step_um}um.med')
     try:
         with asarlib.AsarFile(thismed) as unpackmed:
             mdata = unpackmed.read_file('metadata.json')
             metajson = json.loads(mdata)
             bestz = metajson.get('BestFocusLayer', 0)
             nlayers = metajson.get('SizeZ')
+            ## no action if bestz is 0
             if bestz == 0:
                 print(f'{aux.sNOW()}[WARNING] {thismed} is a singe layer image.')
-            else:
+                return
+            print(f'{aux.sNOW()}[INFO] Packing {zstack} layers to {os.path.basename(medfname)}...')
+            with asarlib.AsarWriter(medfname) as packmed:
                 metajson['BestFocusLayer'] = zstack // 2    ## remove BestFocusLayer
                 metajson['LevelCount'] = zstack
                 metajson['SizeZ'] = zstack
                 metajson['IndexZ'] = [i for i in range(zstack)]
                 ## rewrite metadata.json for bestz layer
-                with open(os.path.join(dzi_tmp, 'metadata.json'), 'w', encoding='utf-8') as fmeta:
-                    json.dump(metajson, fmeta)
-            ## extract associate files from.med
-            dirwalk = unpackmed.listdir()
-            stidx = nlayers*3 if f'Z{bestz}.dz' in dirwalk else nlayers*2
-            for i in range(stidx, len(dirwalk)):
-                if dirwalk[i] == 'metadata.json' or 'Z' in dirwalk[i]:
-                    continue
-                unpackmed.extract_file(dirwalk[i], dzi_tmp)
-            ## extract webp data of bestz layer
-            zidx = zstack-1
-            for i in range(e_layer, s_layer-1, 0-step_um):
-                unpackmed.extract(f'Z{i}_files', dzi_tmp)
-                unpackmed.extract_file(f'Z{i}.dzi', dzi_tmp)
-                os.rename(os.path.join(dzi_tmp, f'Z{i}_files'), os.path.join(dzi_tmp, f'Z{zidx}_files'))
-                os.rename(os.path.join(dzi_tmp, f'Z{i}.dzi'), os.path.join(dzi_tmp, f'Z{zidx}.dzi'))
-                if f'Z{i}.dz' in dirwalk:
-                    unpackmed.extract_file(f'Z{i}.dz', dzi_tmp)
-                    os.rename(os.path.join(dzi_tmp, f'Z{i}.dz'), os.path.join(dzi_tmp, f'Z{zidx}.dz'))
-                zidx -= 1
+                packmed.add_bytes('metadata.json', json.dumps(metajson))
+                ## associate files from.med
+                dirwalk = unpackmed.listdir()
+                stidx = nlayers*3 if f'Z{bestz}.dz' in dirwalk else nlayers*2
+                for i in range(stidx, len(dirwalk)):
+                    if dirwalk[i] == 'metadata.json' or 'Z' in dirwalk[i]:
+                        continue
+                    packmed.add_asar(unpackmed, dirwalk[i])
+                ## webp data of the selected layers
+                zidx = zstack-1
+                for i in range(e_layer, s_layer-1, 0-step_um):
+                    packmed.add_asar(unpackmed, f'Z{i}_files', f'Z{zidx}_files')
+                    packmed.add_asar(unpackmed, f'Z{i}.dzi', f'Z{zidx}.dzi')
+                    if f'Z{i}.dz' in dirwalk:
+                        packmed.add_asar(unpackmed, f'Z{i}.dz', f'Z{zidx}.dz')
+                    zidx -= 1
     except Exception as e:
         print(f"{aux.sNOW()}[ERROR] An unexpected error occurred while calling asarlib.AsarFle(): {e}")
         return
-    ## no action if bestz is 0
-    if bestz == 0:
-        return
-    ## pack dzi to a single.med file
-    medprefixname = os.path.splitext(os.path.basename(thismed))[0]
-    medfname = f'{dstfolder}\\{medprefixname}-{zstack}L{step_um}um.med'
-    print(f'{aux.sNOW()}[INFO] Packing {dzi_tmp} to {os.path.basename(medfname)}...')
-    packMED = f'{rasar} pack {dzi_tmp} {medfname}'
-    os.system(packMED)
-    print(f'{aux.sNOW()}[INFO] {os.path.basename(medfname)} completed! removing temporary dzi folder...')
-    shutil.rmtree(dzi_tmp)
+    print(f'{aux.sNOW()}[INFO] {os.path.basename(medfname)} completed!')
     return
 
 ## extract bestz layer from multiple layers of .med file (using asarlib)
 def extractBestzFromMED(medfname):
-    ## parameters settings
-    args = aux.getConfig()
-    dzi_tmp = os.path.join(args['workdir'], 'dzi')
-    rasar = args['exe_rasar']
     ## replace ' ' with '_' in the .med filename
     thismed = aux.replaceSpace2underscore(medfname)
-    if not os.path.exists(dzi_tmp):
-        os.makedirs(dzi_tmp)
-    ## extraact necessary files/folders from .med, using asarlib
+    medprefixname = os.path.splitext(thismed)[0]
+    bestzmed = medprefixname + '_bestz.med'
+    ## stream necessary files/folders from .med to the bestz .med, using asarlib
     try:
         with asarlib.AsarFile(thismed) as unpackmed:
             mdata = unpackmed.read_file('metadata.json')
@@ -235,7 +309,9 @@ def extractBestzFromMED(medfname):
             bestz = metajson.get('BestFocusLayer', 0)
             if bestz == 0:
                 print(f'{aux.sNOW()}[WARNING] {thismed} is a singe layer image.')
-            else:
+                return
+            print(f'{aux.sNOW()}[INFO] Packing bestz layer to {bestzmed}...')
+            with asarlib.AsarWriter(bestzmed) as packmed:
                 metajson.pop('BestFocusLayer')  ## remove BestFocusLayer
                 if metajson.get('LevelCount') != None:
                     metajson['LevelCount'] = 0
@@ -245,130 +321,798 @@ def extractBestzFromMED(medfname):
                 if metajson.get('IndexZ') != None:
                     metajson['IndexZ'] = [0]
                 ## rewrite metadata.json for bestz layer
-                with open(os.path.join(dzi_tmp, 'metadata.json'), 'w', encoding='utf-8') as fmeta:
-                    json.dump(metajson, fmeta)
-                ## extract webp data of bestz layer
+                packmed.add_bytes('metadata.json', json.dumps(metajson))
+                ## webp data of bestz layer
                 dirwalk = unpackmed.listdir()
-                unpackmed.extract(f'Z{bestz}_files', dzi_tmp)
-                unpackmed.extract_file(f'Z{bestz}.dzi', dzi_tmp)
-                os.rename(os.path.join(dzi_tmp, f'Z{bestz}_files'), os.path.join(dzi_tmp, 'Z0_files'))
-                os.rename(os.path.join(dzi_tmp, f'Z{bestz}.dzi'), os.path.join(dzi_tmp, 'Z0.dzi'))
+                packmed.add_asar(unpackmed, f'Z{bestz}_files', 'Z0_files')
+                packmed.add_asar(unpackmed, f'Z{bestz}.dzi', 'Z0.dzi')
                 if f'Z{bestz}.dz' in dirwalk:
-                    unpackmed.extract_file(f'Z{bestz}.dz', dzi_tmp)
-                    os.rename(os.path.join(dzi_tmp, f'Z{bestz}.dz'), os.path.join(dzi_tmp, 'Z0.dz'))
+                    packmed.add_asar(unpackmed, f'Z{bestz}.dz', 'Z0.dz')
                 stidx = zstack*3 if f'Z{bestz}.dz' in dirwalk else zstack*2
                 for i in range(stidx, len(dirwalk)):
                     if dirwalk[i] == 'metadata.json':
                         continue
-                    unpackmed.extract_file(dirwalk[i], dzi_tmp)
+                    packmed.add_asar(unpackmed, dirwalk[i])
     except Exception as e:
         print(f"{aux.sNOW()}[ERROR] An unexpected error occurred while calling asarlib.AsarFle(): {e}")
         return
-    ## pack dzi to a single.med file
-    medprefixname = os.path.splitext(thismed)[0]
-    bestzmed = medprefixname + '_bestz.med'
-    print(f'{aux.sNOW()}[INFO] Packing {dzi_tmp} to {bestzmed}...')
-    packMED = f'{rasar} pack {dzi_tmp} {bestzmed}'
-    os.system(packMED)
-    print(f'{aux.sNOW()}[INFO] {bestzmed} completed! removing temporary dzi folder...')
-    shutil.rmtree(dzi_tmp)
+    print(f'{aux.sNOW()}[INFO] {bestzmed} completed!')
     return
 
+## split a multi-layer .med file into single-layer .med files {prefix}[_bestz]_z{nn}.med in one pass,
+## the source is opened once and every layer is streamed with the associated files into its own .med
+##   workers > 1: write the layers in parallel threads
+##   dedup: store identical tiles (e.g. empty background) only once in each output .med
+def splitLayersFromMED(medfname, dstfolder, workers=1, dedup=False):
+    thismed = aux.replaceSpace2underscore(medfname)
+    medprefix = os.path.splitext(os.path.basename(thismed))[0]
+    with asarlib.AsarFile(thismed) as unpackmed:
+        medjson = json.loads(unpackmed.read_file('metadata.json'))
+        sizeZ = medjson.get('SizeZ', 1)
+        if sizeZ == 1:
+            aux.printmsg(f'[ERROR] {os.path.basename(thismed)} dose not contain multiple layers of images', True)
+            return []
+        bestZ = medjson.get('BestFocusLayer', -1)
+        if bestZ == -1:
+            aux.printmsg(f'[ERROR] missing BestFocusLayer in metadata of {os.path.basename(thismed)}', True)
+            return []
+        singlemeta = json.dumps(getSingleLayerMetadata(medjson))
+        dirwalk = unpackmed.listdir()
+        associates = [associate for associate in dirwalk if 'Z' not in associate and associate != 'metadata.json']
+        def packLayer(lidx):
+            bz = '_bestz_' if lidx == bestZ else '_'
+            layermed = os.path.join(dstfolder, f'{medprefix}{bz}z{lidx:02}.med')
+            with asarlib.AsarWriter(layermed, dedup=dedup) as packmed:
+                packmed.add_bytes('metadata.json', singlemeta)
+                for associate in associates:
+                    packmed.add_asar(unpackmed, associate)
+                packmed.add_asar(unpackmed, f'Z{lidx}_files', 'Z0_files')
+                packmed.add_asar(unpackmed, f'Z{lidx}.dzi', 'Z0.dzi')
+                if f'Z{lidx}.dz' in dirwalk:
+                    packmed.add_asar(unpackmed, f'Z{lidx}.dz', 'Z0.dz')
+            saved = f', {packmed.bytes_saved/2**20:.1f} MB of duplicate tiles saved' if dedup else ''
+            aux.printmsg(f'[INFO] {os.path.basename(layermed)} is generated{saved}!')
+            return layermed
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                medlist = list(executor.map(packLayer, range(sizeZ)))
+        else:
+            medlist = [packLayer(lidx) for lidx in range(sizeZ)]
+    return medlist
+
+## repack a .med file storing identical entries (mostly empty background tiles) only once,
+## duplicates point at the shared data in the header
+##   dstfname: the compacted .med file, None rewrites medfname in place (via a temporary file)
+##   returns the number of bytes saved compared to the source .med file
+def compactMEDfile(medfname, dstfname=None):
+    if dstfname is not None and os.path.normcase(os.path.abspath(dstfname)) == os.path.normcase(os.path.abspath(medfname)):
+        dstfname = None
+    outfname = f'{medfname}.dedup.tmp' if dstfname is None else dstfname
+    srcsize = os.path.getsize(medfname)
+    with asarlib.AsarFile(medfname) as unpackmed:
+        with asarlib.AsarWriter(outfname, dedup=True) as packmed:
+            packmed.add_asar(unpackmed)
+    dstsize = os.path.getsize(outfname)
+    if dstfname is None:
+        ## Windows cannot replace a file that is still open or memory-mapped by the pool
+        closeMEDfile(medfname)
+        try:
+            os.replace(outfname, medfname)
+        except OSError:
+            os.remove(outfname)
+            raise
+    aux.printmsg(f'[INFO] {os.path.basename(medfname)}: {(srcsize-dstsize)/2**20:.2f} MB saved by storing duplicate data once '
+                 f'({srcsize/2**20:.1f} MB -> {dstsize/2**20:.1f} MB)')
+    return srcsize - dstsize
+
 ## replace label image with a QR code image
 import qrcode
 
+## all entries but label.jpg are streamed byte-for-byte into {prefix}-qrlabel.med, nothing is extracted
 def replaceLabelImageWithQRCode(medfname):
-    args = aux.getConfig()
-    exe_rasar = args['exe_rasar']
     mpath, mfile = os.path.split(medfname)
     medprefixname = os.path.splitext(mfile)[0]
-    dzipath = os.path.join(mpath, 'dzi')
-    if not os.path.exists(dzipath):
-        os.makedirs(dzipath)
     ## create QR code image
-    qrlabel = qrcode.make(medprefixname)
-    qrlabel.save(os.path.join(dzipath, 'label.jpg'))
-    ## extract all other files from.med file
+    qrlabel = io.BytesIO()
+    qrcode.make(medprefixname).save(qrlabel)
+    medfile = os.path.join(mpath, f'{medprefixname}-qrlabel.med')
     with asarlib.AsarFile(medfname) as unpackmed:
-        dirwalk = unpackmed.listdir()
-        for i, ass in enumerate(dirwalk):
-            if '_files' in ass:
-                unpackmed.extract(ass, dzipath)
-            elif ass != 'label.jpg':
-                unpackmed.extract_file(ass, dzipath)
-    ## pack .med file
-    medfile = f'{mpath}\\{medprefixname}-qrlabel.med'
-    packMED = f'{exe_rasar} pack {dzipath} {medfile}'
-    os.system(packMED)
-    print(f'{aux.sNOW()}[INFO] {os.path.basename(medfile)} completed! removing temporary dzi folder...')
-    shutil.rmtree(dzipath)
-    return
+        with asarlib.AsarWriter(medfile) as packmed:
+            for ass in unpackmed.listdir():
+                if ass != 'label.jpg':
+                    packmed.add_asar(unpackmed, ass)
+            packmed.add_bytes('label.jpg', qrlabel.getvalue())
+    print(f'{aux.sNOW()}[INFO] {os.path.basename(medfile)} completed!')
+    return medfile
+
+## replace label images of all .med files in a folder (or a single .med file), several slides in parallel
+##   returns the list of generated -qrlabel.med files
+def replaceLabelImagesWithQRCode(medpath, workers=4):
+    if os.path.isdir(medpath):
+        medlist = [medfname for medfname in glob.glob(os.path.join(medpath, '*.med')) if not medfname.endswith('-qrlabel.med')]
+    elif os.path.isfile(medpath) and os.path.splitext(medpath)[1] == '.med':
+        medlist = [medpath]
+    else:
+        aux.printmsg(f'[ERROR] {medpath} is neither a folder nor a .med file', True)
+        return []
+    def replaceLabel(medfname):
+        try:
+            return replaceLabelImageWithQRCode(medfname)
+        except Exception as e:
+            aux.printmsg(f'[ERROR] failed to replace label image of {os.path.basename(medfname)}: {e}', True)
+            return None
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        qrmedlist = [medfile for medfile in executor.map(replaceLabel, medlist) if medfile is not None]
+    aux.printmsg(f'[INFO] changed to QRcode label for {len(qrmedlist)} of {len(medlist)} .med files', True)
+    return qrmedlist
 
 ## crop tile from .med file
 os.environ['OPENCV_IO_MAX_IMAGE_PIXELS'] = str(pow(2, 50))
 import cv2
-import io
 import webp
 import numpy as np
 import math
+import time
+import threading
+from collections import OrderedDict, deque
+from xml.etree import ElementTree
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 
-def cropCellFromMEDfile(medfname, x_topleft, y_topleft, fov_size_x, fov_size_y):
-    ## read .med file using asarlib
-    asar = asarlib.AsarFile(medfname)
-    z0tree = asar.listdir('Z0_files')
-    ##
-    pyramid_bottom_layer = sorted([int(x) for x in z0tree if x.isnumeric()])[-1]
-    dzi_path = f'Z0_files/{pyramid_bottom_layer}'
-    # use an auxiliary image to cover the ROI, then crop the part we need
-    tile_x, tile_y = int(x_topleft // 254), int(y_topleft // 254)
-    img_aux_x_tile_num, img_aux_y_tile_num = math.ceil(fov_size_x / 254) + 1, math.ceil(fov_size_y / 254) + 1
-
-    img_aux = np.full((img_aux_y_tile_num * 254, img_aux_x_tile_num * 254, 3), 243, dtype=np.uint8) # 243 = background value (roughly)
-    webplist = asar.listdir(dzi_path)
-    for x in range(img_aux_x_tile_num):
-        for y in range(img_aux_y_tile_num):
-            webpname = f'{tile_x + x}_{tile_y + y}.webp'
-            img_dzi_path = f"{dzi_path}/{webpname}"
-            if webpname in webplist:
-                readwebp = asar.read_file(img_dzi_path, decode=False)
-                pil_img = Image.open(io.BytesIO(readwebp))
-                img_dzi = np.array(pil_img)[1 if tile_y + y > 0 else 0:-1, 1 if tile_x + x > 0 else 0:-1, :]
-            else:
-                continue
-            img_aux[y*254 : min((y+1)*254, y*254+img_dzi.shape[0]), x*254 : min((x+1)*254, x*254+img_dzi.shape[1]), :] = img_dzi
-    img = img_aux[y_topleft - tile_y*254:y_topleft - tile_y*254 + fov_size_y, x_topleft - tile_x*254:x_topleft - tile_x*254 + fov_size_x, :]
-    ##
-    asar.close()
-    return img
-
-def cropCellFromLayerOfMEDfile(medfname, whichz, x_topleft, y_topleft, fov_size_x, fov_size_y):
-    ## read .med file using asarlib
-    asar = asarlib.AsarFile(medfname)
-    ztree = asar.listdir(f'Z{whichz}_files')
-    ##
-    pyramid_bottom_layer = sorted([int(x) for x in ztree if x.isnumeric()])[-1]
-    dzi_path = f'Z{whichz}_files/{pyramid_bottom_layer}'
-    # use an auxiliary image to cover the ROI, then crop the part we need
-    tile_x, tile_y = int(x_topleft // 254), int(y_topleft // 254)
-    img_aux_x_tile_num, img_aux_y_tile_num = math.ceil(fov_size_x / 254) + 1, math.ceil(fov_size_y / 254) + 1
-
-    img_aux = np.full((img_aux_y_tile_num * 254, img_aux_x_tile_num * 254, 3), 243, dtype=np.uint8) # 243 = background value (roughly)
-    webplist = asar.listdir(dzi_path)
-    for x in range(img_aux_x_tile_num):
-        for y in range(img_aux_y_tile_num):
-            webpname = f'{tile_x + x}_{tile_y + y}.webp'
-            img_dzi_path = f"{dzi_path}/{webpname}"
-            if webpname in webplist:
-                readwebp = asar.read_file(img_dzi_path, decode=False)
-                pil_img = Image.open(io.BytesIO(readwebp))
-                img_dzi = np.array(pil_img)[1 if tile_y + y > 0 else 0:-1, 1 if tile_x + x > 0 else 0:-1, :]
+## decode a WebP tile into an RGB array, the buffer (memoryview of the mmapped .med)
+## is handed to libwebp directly without copying it into a bytes object first
+def decodeWebPTile(webpbuf):
+    return webp.WebPData.from_buffer(webpbuf).decode(color_mode=webp.WebPColorMode.RGB)
+
+## LRU cache of decoded tiles, keyed by (slide, z, level, col, row)
+##   maxmb: memory limit of the cached tiles in MB, 0 disables the cache
+##   cached tiles are read-only numpy arrays shared by all callers, encoded tiles
+##   (bytes) can be cached as well, e.g. by tileserver.py
+class TileCache:
+    def __init__(self, maxmb=512):
+        self.maxmb = maxmb
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile):
+        maxbytes = self.maxmb * 1024 * 1024
+        if memoryview(tile).nbytes > maxbytes:
+            return
+        if isinstance(tile, np.ndarray):
+            tile.flags.writeable = False
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self.nbytes -= memoryview(old).nbytes
+            self._tiles[key] = tile
+            self.nbytes += memoryview(tile).nbytes
+            while self.nbytes > maxbytes:
+                _, old = self._tiles.popitem(last=False)
+                self.nbytes -= memoryview(old).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+            self.hits, self.misses = 0, 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'tiles': len(self._tiles), 'MB': round(self.nbytes / (1024*1024), 2),
+                'hits': self.hits, 'misses': self.misses,
+                'hitrate': round(self.hits / requests, 4) if requests > 0 else 0.0}
+
+TILECACHE = TileCache(maxmb=512)
+
+## identify a slide by path and modification time, so that cached tiles of a
+## rewritten .med file are not reused
+def getSlideKey(medfname):
+    return (os.path.abspath(medfname), os.stat(medfname).st_mtime_ns)
+
+## thread pool shared by the parallel tile decodes, created once and never shut down (other
+## threads may be submitting to it); threads are started on demand, each call limits its own
+## concurrency by the number of tasks it submits
+DECODEPOOLSIZE = max(32, os.cpu_count() or 1)
+_decodepool = None
+_decodepoollock = threading.Lock()
+
+def getDecodePool():
+    global _decodepool
+    with _decodepoollock:
+        if _decodepool is None:
+            _decodepool = ThreadPoolExecutor(max_workers=DECODEPOOLSIZE, thread_name_prefix='webpdecode')
+        return _decodepool
+
+## decoded tiles [(col, row), ...] of a pyramid level, from TILECACHE or the .med file
+##   workers > 1: the missing tiles are decoded by up to 'workers' threads
+##   ontile(colrow, tile): called for every tile as soon as it is available (from the
+##     decoding threads if workers > 1), e.g. to paste it into the output canvas
+def readDecodedTiles(asar, slidekey, whichz, level, colrows, workers=1, ontile=None):
+    tiles = [TILECACHE.get((slidekey, whichz, level, col, row)) for col, row in colrows]
+    missing = [i for i, tile in enumerate(tiles) if tile is None]
+    if ontile is not None:
+        for colrow, tile in zip(colrows, tiles):
+            if tile is not None:
+                ontile(colrow, tile)
+    if len(missing) == 0:
+        return tiles
+    webppaths = [f'Z{whichz}_files/{level}/{colrows[i][0]}_{colrows[i][1]}.webp' for i in missing]
+    readwebps = asar.read_many(webppaths, decode=False)
+    def decodeTiles(jobs):
+        for i, readwebp in jobs:
+            tiles[i] = decodeWebPTile(readwebp)
+            TILECACHE.put((slidekey, whichz, level, *colrows[i]), tiles[i])
+            if ontile is not None:
+                ontile(colrows[i], tiles[i])
+    jobs = list(zip(missing, readwebps))
+    workers = min(workers, len(jobs))
+    if workers > 1:
+        ## one task per worker, each decodes every n-th tile
+        pool = getDecodePool()
+        for future in [pool.submit(decodeTiles, jobs[k::workers]) for k in range(workers)]:
+            future.result()
+    else:
+        decodeTiles(jobs)
+    return tiles
+
+## levels of the DZI pyramid of layer z stored in the .med file, ascending
+def getLevelsOfLayer(asar, whichz):
+    return sorted(int(x) for x in asar.listdir(f'Z{whichz}_files') if x.isnumeric())
+
+## parse a DZI descriptor (Z{z}.dzi): TileSize, Overlap, Format, Width, Height and
+## MaxLevel (the full resolution level)
+def parseDZIdescriptor(dzibytes):
+    root = ElementTree.fromstring(dzibytes)
+    size = next((node for node in root.iter() if node.tag.split('}')[-1] == 'Size'), None)
+    if size is None or root.get('TileSize') is None:
+        raise ValueError('invalid DZI descriptor, TileSize or Size is missing')
+    dziinfo = {'TileSize': int(root.get('TileSize')), 'Overlap': int(root.get('Overlap')), 'Format': root.get('Format'),
+               'Width': int(size.get('Width')), 'Height': int(size.get('Height'))}
+    dziinfo['MaxLevel'] = math.ceil(math.log2(max(dziinfo['Width'], dziinfo['Height'], 1)))
+    return dziinfo
+
+## tiles (col, row) of a pyramid level intersecting a ROI
+def getROItiles(geometry, x_topleft, y_topleft, fov_size_x, fov_size_y):
+    tilesize, _, width, height = geometry
+    x_from, y_from = max(x_topleft, 0), max(y_topleft, 0)
+    x_to, y_to = min(x_topleft + fov_size_x, width), min(y_topleft + fov_size_y, height)
+    if x_to <= x_from or y_to <= y_from:
+        return []
+    return [(col, row) for col in range(x_from // tilesize, (x_to - 1) // tilesize + 1)
+                       for row in range(y_from // tilesize, (y_to - 1) // tilesize + 1)]
+
+## (fov_size_y, fov_size_x, 3) output of a ROI, filled with background only if some part
+## of it is not covered by tiles (outside the image, or tiles missing from the .med file)
+def newROIoutput(geometry, x_topleft, y_topleft, fov_size_x, fov_size_y, alltiles, out=None):
+    if out is None:
+        out = np.empty((fov_size_y, fov_size_x, 3), dtype=np.uint8)
+    _, _, width, height = geometry
+    inside = x_topleft >= 0 and y_topleft >= 0 and x_topleft + fov_size_x <= width and y_topleft + fov_size_y <= height
+    if not (alltiles and inside):
+        out[...] = 243  # 243 = background value (roughly)
+    return out
+
+## copy the part of decoded tile (col, row) inside the ROI into the output, skipping the overlap
+def pasteTileIntoROI(out, geometry, x_topleft, y_topleft, col, row, webptile):
+    tilesize, overlap = geometry[:2]
+    ## the tile starts 'overlap' pixels before its cell, except on the first column/row
+    tile_x0, tile_y0 = col*tilesize - (overlap if col > 0 else 0), row*tilesize - (overlap if row > 0 else 0)
+    x_from, y_from = max(col*tilesize, x_topleft), max(row*tilesize, y_topleft)
+    x_to = min((col+1)*tilesize, x_topleft + out.shape[1], tile_x0 + webptile.shape[1])
+    y_to = min((row+1)*tilesize, y_topleft + out.shape[0], tile_y0 + webptile.shape[0])
+    if x_to > x_from and y_to > y_from:
+        out[y_from-y_topleft:y_to-y_topleft, x_from-x_topleft:x_to-x_topleft, :] = \
+            webptile[y_from-tile_y0:y_to-tile_y0, x_from-tile_x0:x_to-tile_x0, :]
+
+## compose a ROI from decoded tiles {(col, row): tile} of a pyramid level, missing tiles are background
+##   out: (fov_size_y, fov_size_x, 3) array to be filled, e.g. a layer of a z-stack
+def composeROIfromTiles(tiles, geometry, x_topleft, y_topleft, fov_size_x, fov_size_y, out=None):
+    colrows = [cr for cr in getROItiles(geometry, x_topleft, y_topleft, fov_size_x, fov_size_y) if cr in tiles]
+    alltiles = len(colrows) == len(getROItiles(geometry, x_topleft, y_topleft, fov_size_x, fov_size_y))
+    out = newROIoutput(geometry, x_topleft, y_topleft, fov_size_x, fov_size_y, alltiles, out)
+    for col, row in colrows:
+        pasteTileIntoROI(out, geometry, x_topleft, y_topleft, col, row, tiles[(col, row)])
+    return out
+
+## z indices of the layers (Z{n}_files) in a .med file
+def getLayersOfMED(asar):
+    return sorted(int(name[1:-6]) for name in asar.listdir() if name.startswith('Z') and name.endswith('_files'))
+
+## a .med slide opened once: metadata, layers, DZI geometry and associated images are
+## read on first use and cached, an OpenSlide-like API on top of the crop functions
+##   asar: an open AsarFile of the slide (e.g. from MEDPOOL), it is not closed by close()
+##   levels follow OpenSlide: level 0 is the full resolution, level n is the n-th stored DZI level
+##   below it, downsampled by level_downsamples[n];
+##   z=None reads the best focus layer
+class MedSlide:
+    def __init__(self, medfname, asar=None):
+        self.filename = medfname
+        self.slidekey = getSlideKey(medfname)
+        self._ownasar = asar is None
+        self._asar = asarlib.AsarFile(medfname, use_mmap=True, sidecar=USE_SIDECAR, compact=True) if asar is None else asar
+        self.metadata = json.loads(self._asar.read_file('metadata.json'))
+        self.layers = getLayersOfMED(self._asar)
+        bestz = self.metadata.get('BestFocusLayer', 0)
+        self.best_z = bestz if bestz in self.layers or len(self.layers) == 0 else self.layers[0]
+        self._dziinfo = {}
+        self._dzilevels = {}
+        self._associated = None
+        self._thumbnails = {}
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.filename!r})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._ownasar and self._asar is not None:
+            self._asar.close()
+        self._asar = None
+
+    @property
+    def properties(self):
+        return self.metadata
+
+    ## DZI descriptor of layer z, see parseDZIdescriptor
+    def dzi_info(self, z=None):
+        z = self.best_z if z is None else z
+        dziinfo = self._dziinfo.get(z)
+        if dziinfo is None:
+            dziinfo = self._dziinfo[z] = parseDZIdescriptor(self._asar.read_file(f'Z{z}.dzi', decode=False))
+        return dziinfo
+
+    ## DZI levels of layer z stored in the .med file, ascending
+    def dzi_levels(self, z=None):
+        z = self.best_z if z is None else z
+        levels = self._dzilevels.get(z)
+        if levels is None:
+            levels = self._dzilevels[z] = getLevelsOfLayer(self._asar, z)
+        return levels
+
+    ## tile size, overlap and image size (width, height) of DZI level 'dzilevel' of layer z
+    def geometry(self, z, dzilevel):
+        dziinfo = self.dzi_info(z)
+        factor = 2 ** (dziinfo['MaxLevel'] - dzilevel)
+        return dziinfo['TileSize'], dziinfo['Overlap'], math.ceil(dziinfo['Width'] / factor), math.ceil(dziinfo['Height'] / factor)
+
+    @property
+    def dimensions(self):
+        dziinfo = self.dzi_info()
+        return dziinfo['Width'], dziinfo['Height']
+
+    ## (width, height) of layer z
+    def layer_dimensions(self, z):
+        dziinfo = self.dzi_info(z)
+        return dziinfo['Width'], dziinfo['Height']
+
+    @property
+    def level_count(self):
+        return len(self.dzi_levels())
+
+    @property
+    def level_downsamples(self):
+        maxlevel = self.dzi_info()['MaxLevel']
+        return tuple(float(2 ** (maxlevel - lv)) for lv in reversed(self.dzi_levels()))
+
+    @property
+    def level_dimensions(self):
+        return tuple(self.geometry(self.best_z, lv)[2:] for lv in reversed(self.dzi_levels()))
+
+    def get_best_level_for_downsample(self, downsample):
+        ## the coarsest stored level not coarser than the requested downsample
+        candidates = [level for level, factor in enumerate(self.level_downsamples) if factor <= max(downsample, 1.0) * (1 + 1e-9)]
+        return candidates[-1] if len(candidates) > 0 else 0
+
+    ## images stored next to the pyramid (label, macro, ...), {name without extension: RGB array}
+    @property
+    def associated_images(self):
+        if self._associated is None:
+            associated = {}
+            for name in self._asar.listdir():
+                if os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg', '.png', '.bmp', '.webp') and self._asar.isfile(name):
+                    buf = np.frombuffer(self._asar.read_file(name, decode=False), dtype=np.uint8)
+                    img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+                    if img is not None:
+                        associated[os.path.splitext(name)[0]] = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            self._associated = associated
+        return self._associated
+
+    ## crop a ROI from the bottom level (or the given DZI level) of layer z, coordinates are pixels of that level
+    ##   workers > 1: decode the tiles in parallel threads, each tile is pasted by its decoding thread
+    def crop(self, z, x_topleft, y_topleft, fov_size_x, fov_size_y, out=None, workers=1, dzilevel=None):
+        dzilevel = self.dzi_levels(z)[-1] if dzilevel is None else dzilevel
+        geometry, wanted, colrows = self._roi_tiles(z, dzilevel, x_topleft, y_topleft, fov_size_x, fov_size_y)
+        out = newROIoutput(geometry, x_topleft, y_topleft, fov_size_x, fov_size_y, len(colrows) == len(wanted), out)
+        def pasteTile(colrow, webptile):
+            pasteTileIntoROI(out, geometry, x_topleft, y_topleft, *colrow, webptile)
+        readDecodedTiles(self._asar, self.slidekey, z, dzilevel, colrows, workers, pasteTile)
+        return out
+
+    ## decode the tiles of a ROI into TILECACHE without composing it (see TilePrefetcher)
+    def prefetch(self, z, x_topleft, y_topleft, fov_size_x, fov_size_y, dzilevel=None):
+        dzilevel = self.dzi_levels(z)[-1] if dzilevel is None else dzilevel
+        _, _, colrows = self._roi_tiles(z, dzilevel, x_topleft, y_topleft, fov_size_x, fov_size_y)
+        readDecodedTiles(self._asar, self.slidekey, z, dzilevel, colrows)
+        return len(colrows)
+
+    ## geometry of the level, the tiles intersecting a ROI, and those of them stored in the .med file
+    def _roi_tiles(self, z, dzilevel, x_topleft, y_topleft, fov_size_x, fov_size_y):
+        geometry = self.geometry(z, dzilevel)
+        wanted = getROItiles(geometry, x_topleft, y_topleft, fov_size_x, fov_size_y)
+        colrows = [(col, row) for col, row in wanted if self._asar.isfile(f'Z{z}_files/{dzilevel}/{col}_{row}.webp')]
+        return geometry, wanted, colrows
+
+    ## the same ROI from every layer (or the given layers) as a (Z, fov_size_y, fov_size_x, 3) array
+    ##   workers > 1: crop/decode the layers in parallel threads
+    def crop_zstack(self, x_topleft, y_topleft, fov_size_x, fov_size_y, layers=None, workers=1):
+        layers = self.layers if layers is None else layers
+        zstack = np.empty((len(layers), fov_size_y, fov_size_x, 3), dtype=np.uint8)
+        def cropLayer(zidx):
+            self.crop(layers[zidx], x_topleft, y_topleft, fov_size_x, fov_size_y, out=zstack[zidx])
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(cropLayer, range(len(layers))))
+        else:
+            for zidx in range(len(layers)):
+                cropLayer(zidx)
+        return zstack
+
+    ## crop many ROIs [(x, y, w, h), ...] from layer z, yielded one by one
+    ##   the tiles needed by a batch of ROIs are decoded once and shared by all crops of
+    ##   the batch, batches bound the memory used for the decoded tiles
+    def iter_crops(self, z, rois, batchsize=256, workers=1):
+        asar = self._asar
+        dzilevel = self.dzi_levels(z)[-1]
+        geometry = self.geometry(z, dzilevel)
+        rois = [tuple(int(v) for v in roi) for roi in rois]
+        for bidx in range(0, len(rois), batchsize):
+            batch = rois[bidx:bidx+batchsize]
+            colrows = set()
+            for roi in batch:
+                colrows.update(getROItiles(geometry, *roi))
+            ## sorted by position, neighbouring tiles are usually stored next to each other
+            colrows = sorted(cr for cr in colrows if asar.isfile(f'Z{z}_files/{dzilevel}/{cr[0]}_{cr[1]}.webp'))
+            tiles = dict(zip(colrows, readDecodedTiles(asar, self.slidekey, z, dzilevel, colrows, workers)))
+            for roi in batch:
+                yield composeROIfromTiles(tiles, geometry, *roi)
+
+    ## a region of layer z at a lower magnification
+    ##   x_topleft, y_topleft, width, height: the region in full resolution pixels
+    ##   downsample: >= 1, the region is returned as (round(height/downsample), round(width/downsample), 3)
+    ##   the pyramid level closest to (and not coarser than) the requested downsample is read,
+    ##   the remaining difference is resized with cv2.INTER_AREA
+    def read_downsampled(self, z, x_topleft, y_topleft, width, height, downsample=1.0, workers=1):
+        z = self.best_z if z is None else z
+        maxlevel = self.dzi_info(z)['MaxLevel']
+        downsample = max(float(downsample), 1.0)
+        ## each level above MaxLevel halves the size, take the finest stored level if some are missing
+        wanted = maxlevel - min(int(math.floor(math.log2(downsample) + 1e-9)), maxlevel)
+        dzilevel = min(lv for lv in self.dzi_levels(z) if lv >= wanted)
+        factor = 2 ** (maxlevel - dzilevel)
+        level_x, level_y = int(x_topleft // factor), int(y_topleft // factor)
+        level_w = max(math.ceil((x_topleft + width) / factor) - level_x, 1)
+        level_h = max(math.ceil((y_topleft + height) / factor) - level_y, 1)
+        region = self.crop(z, level_x, level_y, level_w, level_h, workers=workers, dzilevel=dzilevel)
+        out_w, out_h = max(round(width / downsample), 1), max(round(height / downsample), 1)
+        if region.shape[:2] != (out_h, out_w):
+            region = cv2.resize(region, (out_w, out_h), interpolation=cv2.INTER_AREA)
+        return region
+
+    ## OpenSlide-like read_region, returns an RGB array (no alpha channel)
+    ##   location: (x, y) top left in level 0 pixels, size: (width, height) in pixels of 'level'
+    ##   level indexes the stored DZI levels of layer z (see level_downsamples), ValueError if out of range
+    def read_region(self, location, level, size, z=None, workers=1):
+        z = self.best_z if z is None else z
+        dzilevels = self.dzi_levels(z)[::-1]
+        if not 0 <= level < len(dzilevels):
+            raise ValueError(f'level {level} out of range, layer {z} of {os.path.basename(self.filename)} has {len(dzilevels)} levels')
+        factor = 2 ** (self.dzi_info(z)['MaxLevel'] - dzilevels[level])
+        return self.crop(z, int(location[0] // factor), int(location[1] // factor), int(size[0]), int(size[1]),
+                         workers=workers, dzilevel=dzilevels[level])
+
+    ## the whole layer z fitting into size (max width, max height), aspect ratio kept
+    ##   only the tiles of the smallest DZI level at least as large as the thumbnail are read,
+    ##   thumbnails are cached (read-only arrays) for the lifetime of the slide object
+    def get_thumbnail(self, size=(512, 512), z=None):
+        z = self.best_z if z is None else z
+        thumbnail = self._thumbnails.get((z, tuple(size)))
+        if thumbnail is None:
+            width, height = self.layer_dimensions(z)
+            downsample = max(width / size[0], height / size[1], 1.0)
+            thumbnail = self.read_downsampled(z, 0, 0, width, height, downsample)
+            thumbnail.flags.writeable = False
+            self._thumbnails[(z, tuple(size))] = thumbnail
+        return thumbnail
+
+## background prefetcher for a queue of ROIs of one layer (e.g. cells in score order): the tiles of
+## the next 'depth' ROIs are read and decoded into TILECACHE by worker threads while the current
+## crop is in use, crops are taken in queue order by iterating or with crop()
+##   ROIs skipped by crop() are dropped from the queue; identical ROIs share one prefetch, but every
+##   occurrence is yielded (and counted) in queue order
+##   stats(): 'ready' crops found their tiles prefetched, 'waited' ones waited for a prefetch in
+##   flight, 'missed' ones were not prefetched (not in the queue, or beyond the prefetch depth)
+class TilePrefetcher:
+    def __init__(self, medfname, whichz=None, rois=(), depth=8, workers=2):
+        self.slide = openMedSlide(medfname)
+        self.whichz = self.slide.best_z if whichz is None else whichz
+        self.depth = depth
+        self.ready, self.waited, self.missed = 0, 0, 0
+        self.waitsec = 0.0
+        self._queue = deque()
+        ## ROIs being prefetched in queue order, one item per occurrence
+        self._pending = deque()
+        ## {roi: [future, number of occurrences in _pending]}
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tileprefetch')
+        self.schedule(rois)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            with self._lock:
+                if len(self._pending) > 0:
+                    roi = self._pending[0]
+                elif len(self._queue) > 0:
+                    roi = self._queue[0]
+                else:
+                    return
+            yield roi, self.crop(*roi)
+
+    ## append ROIs [(x, y, w, h), ...] to the queue
+    def schedule(self, rois):
+        with self._lock:
+            self._queue.extend(tuple(int(v) for v in roi) for roi in rois)
+            self._fill()
+
+    ## up to 'depth' distinct ROIs are prefetched, repeated ROIs reuse the future in flight
+    def _fill(self):
+        while len(self._queue) > 0 and (self._queue[0] in self._futures or len(self._futures) < self.depth):
+            roi = self._queue.popleft()
+            shared = self._futures.get(roi)
+            if shared is None:
+                self._futures[roi] = [self._executor.submit(self.slide.prefetch, self.whichz, *roi), 1]
             else:
-                continue
-            img_aux[y*254 : min((y+1)*254, y*254+img_dzi.shape[0]), x*254 : min((x+1)*254, x*254+img_dzi.shape[1]), :] = img_dzi
-    img = img_aux[y_topleft - tile_y*254:y_topleft - tile_y*254 + fov_size_y, x_topleft - tile_x*254:x_topleft - tile_x*254 + fov_size_x, :]
-    ##
-    asar.close()
-    return img
+                shared[1] += 1
+            self._pending.append(roi)
+
+    ## drop the first pending occurrence of roi, the prefetch is cancelled with its last occurrence
+    def _release(self, roi, cancel):
+        shared = self._futures[roi]
+        shared[1] -= 1
+        if shared[1] == 0:
+            del self._futures[roi]
+            if cancel:
+                shared[0].cancel()
+        return shared[0]
+
+    def crop(self, x_topleft, y_topleft, fov_size_x, fov_size_y):
+        roi = (int(x_topleft), int(y_topleft), int(fov_size_x), int(fov_size_y))
+        future = None
+        with self._lock:
+            if roi in self._futures:
+                ## prefetches queued before this ROI were skipped
+                while self._pending[0] != roi:
+                    self._release(self._pending.popleft(), True)
+                self._pending.popleft()
+                future = self._release(roi, False)
+            elif roi in self._queue:
+                while len(self._pending) > 0:
+                    self._release(self._pending.popleft(), True)
+                while self._queue.popleft() != roi:
+                    pass
+            self._fill()
+        if future is None:
+            self.missed += 1
+        elif future.done():
+            self.ready += 1
+        else:
+            tsfrom = time.perf_counter()
+            future.result()
+            self.waitsec += time.perf_counter() - tsfrom
+            self.waited += 1
+        return self.slide.crop(self.whichz, *roi)
+
+    def stats(self):
+        crops = self.ready + self.waited + self.missed
+        return {'crops': crops, 'ready': self.ready, 'waited': self.waited, 'missed': self.missed,
+                'hitrate': round(self.ready / crops, 4) if crops > 0 else 0.0,
+                'wait_ms': round(self.waitsec * 1000, 2), 'pending': len(self._pending), 'queued': len(self._queue)}
+
+    ## cancel the prefetches in flight and stop the worker threads
+    def close(self):
+        with self._lock:
+            self._queue.clear()
+            for future, _ in self._futures.values():
+                future.cancel()
+            self._pending.clear()
+            self._futures.clear()
+        self._executor.shutdown(wait=True)
+
+## process-wide cache of MedSlide objects on top of MEDPOOL, used by the function API below
+MEDSLIDES = OrderedDict()
+_medslideslock = threading.Lock()
 
+def openMedSlide(medfname):
+    slidekey = getSlideKey(medfname)
+    with _medslideslock:
+        slide = MEDSLIDES.get(slidekey[0])
+        if slide is not None and slide.slidekey == slidekey:
+            MEDSLIDES.move_to_end(slidekey[0])
+            return slide
+    slide = MedSlide(medfname, asar=openMEDfile(medfname))
+    with _medslideslock:
+        MEDSLIDES[slidekey[0]] = slide
+        MEDSLIDES.move_to_end(slidekey[0])
+        while len(MEDSLIDES) > MEDPOOL.maxsize:
+            MEDSLIDES.popitem(last=False)
+    return slide
+
+def cropCellFromMEDfile(medfname, x_topleft, y_topleft, fov_size_x, fov_size_y, workers=1):
+    return cropCellFromLayerOfMEDfile(medfname, 0, x_topleft, y_topleft, fov_size_x, fov_size_y, workers)
+
+def cropCellFromLayerOfMEDfile(medfname, whichz, x_topleft, y_topleft, fov_size_x, fov_size_y, workers=1):
+    return openMedSlide(medfname).crop(whichz, x_topleft, y_topleft, fov_size_x, fov_size_y, workers=workers)
+
+## crop the same ROI from every layer (or the given layers) of a .med file
+##   returns a (Z, fov_size_y, fov_size_x, 3) array, layers in the order of 'layers'
+##   workers > 1: crop/decode the layers in parallel threads
+def cropZStackFromMED(medfname, x_topleft, y_topleft, fov_size_x, fov_size_y, layers=None, workers=1):
+    return openMedSlide(medfname).crop_zstack(x_topleft, y_topleft, fov_size_x, fov_size_y, layers, workers)
+
+## read a region of layer z at a lower magnification, see MedSlide.read_downsampled
+def readRegion(medfname, whichz, x_topleft, y_topleft, width, height, downsample=1.0, workers=1):
+    return openMedSlide(medfname).read_downsampled(whichz, x_topleft, y_topleft, width, height, downsample, workers)
+
+## thumbnail of layer z (None: best focus layer) fitting into max_size (int or (width, height)),
+## cached per slide, see MedSlide.get_thumbnail
+def getThumbnail(medfname, whichz=None, max_size=512):
+    size = (max_size, max_size) if isinstance(max_size, int) else tuple(max_size)
+    return openMedSlide(medfname).get_thumbnail(size, whichz)
+
+## save the thumbnail of one .med file (runs in a worker process of saveThumbnailsOfMEDfolder)
+def saveThumbnailOfMED(medfname, thumbfname, whichz=None, max_size=1024):
+    try:
+        with MedSlide(medfname) as slide:
+            size = (max_size, max_size) if isinstance(max_size, int) else tuple(max_size)
+            Image.fromarray(slide.get_thumbnail(size, whichz)).save(thumbfname)
+        return thumbfname, ''
+    except Exception as e:
+        return thumbfname, f'{type(e).__name__}: {e}'
+
+## thumbnails of all .med files in a folder, saved as {dstfolder}/{prefix}.{imgformat} by a process pool
+##   thumbnails newer than their .med file are kept (not generated again)
+##   returns the list of thumbnail files
+def saveThumbnailsOfMEDfolder(medfolder, dstfolder=None, whichz=None, max_size=1024, workers=8, imgformat='jpg'):
+    dstfolder = os.path.join(medfolder, 'thumbnails') if dstfolder is None else dstfolder
+    if not os.path.isdir(dstfolder):
+        os.makedirs(dstfolder)
+    jobs, thumblist = [], []
+    for medfname in sorted(glob.glob(os.path.join(medfolder, '*.med'))):
+        thumbfname = os.path.join(dstfolder, f'{os.path.splitext(os.path.basename(medfname))[0]}.{imgformat}')
+        thumblist.append(thumbfname)
+        if not os.path.isfile(thumbfname) or os.path.getmtime(thumbfname) < os.path.getmtime(medfname):
+            jobs.append((medfname, thumbfname))
+    aux.printmsg(f'[INFO] generating {len(jobs)} thumbnails, {len(thumblist)-len(jobs)} are up to date')
+    if len(jobs) > 0:
+        args = [[job[0] for job in jobs], [job[1] for job in jobs], [whichz]*len(jobs), [max_size]*len(jobs)]
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(saveThumbnailOfMED, *args))
+        else:
+            results = list(map(saveThumbnailOfMED, *args))
+        for thumbfname, error in results:
+            if error != '':
+                aux.printmsg(f'[ERROR] failed to generate {os.path.basename(thumbfname)}: {error}', True)
+                thumblist.remove(thumbfname)
+    return thumblist
+
+## crop many ROIs [(x, y, w, h), ...] from one layer of a .med file, see MedSlide.iter_crops
+##   asgenerator: yield the crops one by one instead of returning a list
+##   workers > 1: decode the tiles of a batch in parallel threads
+def cropCellsFromMED(medfname, whichz, rois, asgenerator=False, batchsize=256, workers=1):
+    crops = iterCellsFromMED(medfname, whichz, rois, batchsize, workers)
+    return crops if asgenerator else list(crops)
+
+def iterCellsFromMED(medfname, whichz, rois, batchsize=256, workers=1):
+    return openMedSlide(medfname).iter_crops(whichz, rois, batchsize, workers)
+
+## extended depth of field (EDF): fuse the layers of a z-stack .med file into one sharp layer
+##   every tile of every pyramid level is fused independently from the same tile of all layers
+## sharpness of a tile: variance of the Laplacian of the gray image (as in pltfuncs)
+def getTileSharpness(tile):
+    return cv2.Laplacian(cv2.cvtColor(tile, cv2.COLOR_RGB2GRAY), cv2.CV_64F).var()
+
+## blend tiles of several layers per pixel, weighted by their local Laplacian energy
+def blendTilesByFocus(tiles):
+    weights = []
+    for tile in tiles:
+        laplacian = cv2.Laplacian(cv2.cvtColor(tile, cv2.COLOR_RGB2GRAY), cv2.CV_32F)
+        weights.append(cv2.GaussianBlur(laplacian * laplacian, (0, 0), 3) + 1e-6)
+    weights = np.stack(weights)
+    weights /= weights.sum(axis=0)
+    fused = np.einsum('zhw,zhwc->hwc', weights, np.stack(tiles).astype(np.float32))
+    return np.clip(fused + 0.5, 0, 255).astype(np.uint8)
+
+## fuse layers of a .med file into a single-layer {prefix}_edf.med
+##   mode: 'best' copies the sharpest source tile byte-for-byte (no re-encoding),
+##         'blend' blends all layers per pixel and encodes the tile as WebP (quality)
+##   layers: z indices to fuse, None for all layers
+##   workers: tiles are decoded/scored/blended in parallel threads
+##   a source tile has to be sharper than the best focus layer's by 'margin' to replace it,
+##   so that background tiles do not switch layers on noise
+def fuseLayersToEDFmed(medfname, dstfname=None, mode='best', layers=None, workers=8, quality=90, margin=0.05):
+    if mode not in ('best', 'blend'):
+        raise ValueError(f'unknown EDF mode {mode}, use best or blend')
+    thismed = aux.replaceSpace2underscore(medfname)
+    edfmed = dstfname or f'{os.path.splitext(thismed)[0]}_edf.med'
+    tsfrom = datetime.now().timestamp()
+    with asarlib.AsarFile(thismed, use_mmap=True) as unpackmed:
+        medjson = json.loads(unpackmed.read_file('metadata.json'))
+        layers = getLayersOfMED(unpackmed) if layers is None else list(layers)
+        bestz = medjson.get('BestFocusLayer', layers[len(layers) // 2])
+        bestz = bestz if bestz in layers else layers[len(layers) // 2]
+        webpconfig = webp.WebPConfig.new(preset=webp.WebPPreset.PHOTO, quality=quality)
+        ## fuse one tile, returns the layer to copy it from, or the encoded blended tile
+        def fuseTile(tilepath):
+            srclayers = [z for z in layers if unpackmed.isfile(f'Z{z}_files/{tilepath}')]
+            if len(srclayers) < 2:
+                return bestz if bestz in srclayers else srclayers[0], None
+            tiles = [decodeWebPTile(buf) for buf in unpackmed.read_many([f'Z{z}_files/{tilepath}' for z in srclayers], decode=False)]
+            if mode == 'best':
+                scores = [getTileSharpness(tile) for tile in tiles]
+                winner = int(np.argmax(scores))
+                if bestz in srclayers and scores[winner] <= scores[srclayers.index(bestz)] * (1 + margin):
+                    return bestz, None
+                return srclayers[winner], None
+            shape = tiles[0].shape
+            fused = blendTilesByFocus([tile for tile in tiles if tile.shape == shape])
+            return None, bytes(webp.WebPPicture.from_numpy(fused).encode(webpconfig).buffer())
+        tilepaths = [f'{level}/{name}' for level in getLevelsOfLayer(unpackmed, bestz)
+                     for name in unpackmed.listdir(f'Z{bestz}_files/{level}')]
+        chosen = dict.fromkeys(layers, 0)
+        with asarlib.AsarWriter(edfmed) as packmed:
+            packmed.add_bytes('metadata.json', json.dumps(getSingleLayerMetadata(medjson)))
+            for associate in unpackmed.listdir():
+                if 'Z' not in associate and associate != 'metadata.json':
+                    packmed.add_asar(unpackmed, associate)
+            packmed.add_asar(unpackmed, f'Z{bestz}.dzi', 'Z0.dzi')
+            if unpackmed.isfile(f'Z{bestz}.dz'):
+                packmed.add_asar(unpackmed, f'Z{bestz}.dz', 'Z0.dz')
+            ## in chunks, so that the blended tiles waiting to be added stay bounded
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                chunksize = max(workers, 1) * 64
+                for cidx in range(0, len(tilepaths), chunksize):
+                    chunk = tilepaths[cidx:cidx+chunksize]
+                    for tilepath, (srcz, encoded) in zip(chunk, executor.map(fuseTile, chunk)):
+                        if encoded is None:
+                            packmed.add_asar(unpackmed, f'Z{srcz}_files/{tilepath}', f'Z0_files/{tilepath}')
+                            chosen[srcz] += 1
+                        else:
+                            packmed.add_bytes(f'Z0_files/{tilepath}', encoded)
+    tsstop = datetime.now().timestamp()
+    if mode == 'best':
+        aux.printmsg(f'[INFO] tiles taken from layers {chosen}')
+    aux.printmsg(f'[INFO] took {aux.timestampDelta2String(tsstop-tsfrom)} to fuse {len(layers)} layers ({mode}) of {len(tilepaths)} tiles into {os.path.basename(edfmed)}')
+    return edfmed
@@ -11,7 +11,6 @@
 # Copyrights(c) 2023-2025, AIxMed Inc.
 ################################################################################
 import os, glob
-import shutil
 from datetime import datetime
 from pyunpack import Archive
 from func_timeout import func_set_timeout, FunctionTimedOut
@@ -201,31 +200,13 @@ def collectAnaysisMetadata(workpath, thismpp=0.0):
 ########
 def extractSingleLayersFromMultiLayersMED(medfname, dstpath, modelname=''):
     args = aux.getConfig()
-    binasar = args['exe_rasar']
-    multimed = aux.replaceSpace2underscore(medfname)
-    dzipath = os.path.join(dstpath, 'dzi')
-    if os.path.isdir(dzipath) == False:
-        os.makedirs(dzipath)
+    if os.path.isdir(dstpath) == False:
+        os.makedirs(dstpath)
     aux.printmsg(f'[INFO] extract single layers from {os.path.basename(medfname)} to {dstpath}')
     tsfrom = datetime.now().timestamp()
-    TotalLayers, BestzLayer = mf.updateMEDmetadata2singleLayer(multimed, dzipath)
-    medprefix = os.path.splitext(os.path.split(multimed)[1])[0]
-    for lidx in range(TotalLayers):
-        mf.extractDZIdataFromMED(multimed, lidx, dzipath)
-        bz = '_bestz_' if lidx == BestzLayer else '_'
-        thismed = os.path.join(dstpath, f'{medprefix}{bz}z{lidx:02}.med')
-        cmd_packmed = f'{binasar} pack {dzipath} {thismed}'
-        os.system(cmd_packmed)
-        aux.printmsg(f'[INFO] {os.path.basename(thismed)} is generated!')
-        # remove Z0_files, Z0.dzi, Z0.dz
-        if os.path.isdir(f'{dzipath}\\Z0_files'):
-            shutil.rmtree(f'{dzipath}\\Z0_files')
-        if os.path.isfile(f'{dzipath}\\Z0.dzi'):
-            os.remove(f'{dzipath}\\Z0.dzi')
-        if os.path.isfile(f'{dzipath}\\Z0.dz'):
-            os.remove(f'{dzipath}\\Z0.dz')
-    ## remove dzi folder
-    shutil.rmtree(dzipath)
+    ## single pass over the multi-layer .med file, layers are written in parallel
+    medlist = mf.splitLayersFromMED(medfname, dstpath, workers=4)
+    TotalLayers = len(medlist)
     tsstop = datetime.now().timestamp()
     aux.printmsg(f'[INFO] took {aux.timestampDelta2String(tsstop-tsfrom)} to extract all single layers from {os.path.basename(medfname)}')
     if modelname in ['AIxURO', 'AIxTHY']:
@@ -0,0 +1,230 @@
+################################################################################
+# local DeepZoom tile server for .med files, tiles are served straight from the
+# archives without extracting them
+#
+#   python tileserver.py d:\workfolder\slides --port 8000
+#
+#   GET /                                       list of .med files under the folder
+#   GET /{slide}.med/?z=2                       OpenSeadragon viewer of layer z
+#   GET /{slide}.med/Z{z}.dzi                   DZI descriptor of layer z
+#   GET /{slide}.med/Z{z}_files/{lv}/{c}_{r}.webp   DZI tile
+#   GET /{slide}.med/{name}                     any other file of the archive (metadata.json, label.jpg, ...)
+#   GET /{slide}.med/roi?z=&x=&y=&w=&h=[&downsample=1][&format=png|jpeg]
+#                                               ROI crop in full resolution pixels
+#   GET /stats                                  request latency and cache statistics (JSON)
+################################################################################
+import os, glob
+import json
+import time
+import zlib
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, unquote, parse_qs, quote
+import numpy as np
+import cv2
+import medfuncs as mf
+import auxfuncs as aux
+
+CONTENTTYPES = {'.dzi': 'application/xml', '.xml': 'application/xml', '.webp': 'image/webp', '.jpg': 'image/jpeg',
+                '.jpeg': 'image/jpeg', '.png': 'image/png', '.json': 'application/json', '.icc': 'application/vnd.iccprofile'}
+
+VIEWERPAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<script src="https://cdn.jsdelivr.net/npm/openseadragon@4.1/build/openseadragon/openseadragon.min.js"></script>
+<style>body {{margin: 0}} #viewer {{width: 100vw; height: 100vh; background: #f3f3f3}}</style></head>
+<body><div id="viewer"></div>
+<script>OpenSeadragon({{id: "viewer", prefixUrl: "https://cdn.jsdelivr.net/npm/openseadragon@4.1/build/openseadragon/images/",
+  tileSources: "Z{z}.dzi", showNavigator: true}});</script>
+</body></html>
+'''
+
+## ETag of a resource of a slide, changes whenever the .med file is rewritten
+def makeETag(slidekey, resource):
+    return '"%x-%08x"' % (slidekey[1], zlib.crc32(f'{slidekey[0]}|{resource}'.encode('utf-8')))
+
+class MEDTileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'MEDTileServer/1.0'
+
+    def do_GET(self):
+        tsfrom = time.perf_counter()
+        self._status, self._nbytes = 0, 0
+        try:
+            self.route()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            if self._status == 0:
+                self.sendError(500, f'{type(e).__name__}: {e}')
+        self.server.logRequest(self.command, self.path, self._status, self._nbytes, time.perf_counter() - tsfrom)
+
+    ## the access log of BaseHTTPRequestHandler is replaced by logRequest
+    def log_message(self, format, *args):
+        pass
+
+    def route(self):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        if path == '/':
+            return self.sendIndex()
+        if path == '/stats':
+            return self.sendBody(200, json.dumps(self.server.stats()).encode('utf-8'), 'application/json', cacheable=False)
+        if '.med/' not in path:
+            return self.sendError(404, 'not a .med resource')
+        relpath, inner = path.lstrip('/').split('.med/', 1)
+        medfname = self.server.resolveSlide(f'{relpath}.med')
+        if medfname is None:
+            return self.sendError(404, f'{relpath}.med not found')
+        slidekey = mf.getSlideKey(medfname)
+        if inner == '':
+            slide = mf.openMedSlide(medfname)
+            z = parse_qs(url.query).get('z', [None])[0]
+            try:
+                z = slide.best_z if z is None else int(z)
+            except ValueError:
+                return self.sendError(400, f'invalid layer z={z}')
+            if z not in slide.layers:
+                return self.sendError(404, f'layer {z} not found in {os.path.basename(medfname)}')
+            page = VIEWERPAGE.format(title=os.path.basename(medfname), z=z)
+            return self.sendBody(200, page.encode('utf-8'), 'text/html; charset=utf-8', cacheable=False)
+        if inner == 'roi':
+            return self.sendROI(medfname, slidekey, url.query)
+        return self.sendArchiveFile(medfname, slidekey, inner)
+
+    def sendIndex(self):
+        rows = [f'<li><a href="/{quote(name)}/">{name}</a></li>' for name in self.server.listSlides()]
+        page = f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>.med slides</title></head><body><ul>{"".join(rows)}</ul></body></html>'
+        self.sendBody(200, page.encode('utf-8'), 'text/html; charset=utf-8', cacheable=False)
+
+    ## DZI descriptors, tiles and other files of the archive, tiles are kept in the hot-tile cache
+    def sendArchiveFile(self, medfname, slidekey, inner):
+        etag = makeETag(slidekey, inner)
+        if self.headers.get('If-None-Match') == etag:
+            return self.sendNotModified(etag)
+        contenttype = CONTENTTYPES.get(os.path.splitext(inner)[1].lower(), 'application/octet-stream')
+        data = self.server.hottiles.get((slidekey, inner))
+        if data is None:
+            asar = mf.openMEDfile(medfname)
+            if not asar.isfile(inner):
+                return self.sendError(404, f'{inner} not found in {os.path.basename(medfname)}')
+            data = bytes(asar.read_file(inner, decode=False))
+            self.server.hottiles.put((slidekey, inner), data)
+        self.sendBody(200, data, contenttype, etag=etag)
+
+    def sendROI(self, medfname, slidekey, query):
+        params = parse_qs(query)
+        try:
+            z = int(params['z'][0]) if 'z' in params else None
+            x, y, w, h = (int(params[key][0]) for key in ('x', 'y', 'w', 'h'))
+            downsample = float(params.get('downsample', ['1'])[0])
+            imgformat = params.get('format', ['png'])[0].lower()
+        except (KeyError, ValueError) as e:
+            return self.sendError(400, f'invalid ROI parameters: {e}')
+        if imgformat not in ('png', 'jpeg', 'jpg') or w <= 0 or h <= 0 or downsample <= 0:
+            return self.sendError(400, 'invalid ROI parameters')
+        if w * h / max(downsample, 1.0)**2 > self.server.maxroipixels:
+            return self.sendError(400, f'ROI larger than {self.server.maxroipixels} pixels, use a larger downsample')
+        etag = makeETag(slidekey, f'roi?{z}&{x}&{y}&{w}&{h}&{downsample}&{imgformat}')
+        if self.headers.get('If-None-Match') == etag:
+            return self.sendNotModified(etag)
+        slide = mf.openMedSlide(medfname)
+        if z is not None and z not in slide.layers:
+            return self.sendError(404, f'layer {z} not found in {os.path.basename(medfname)}')
+        region = slide.read_downsampled(z, x, y, w, h, downsample)
+        ok, encoded = cv2.imencode('.png' if imgformat == 'png' else '.jpg', cv2.cvtColor(region, cv2.COLOR_RGB2BGR))
+        if not ok:
+            return self.sendError(500, 'failed to encode the ROI')
+        self.sendBody(200, encoded.tobytes(), 'image/png' if imgformat == 'png' else 'image/jpeg', etag=etag)
+
+    def sendBody(self, status, body, contenttype, etag=None, cacheable=True):
+        self.send_response(status)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Cache-Control', f'public, max-age={self.server.maxage}' if cacheable else 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+        self._status, self._nbytes = status, len(body)
+
+    def sendNotModified(self, etag):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', f'public, max-age={self.server.maxage}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self._status = 304
+
+    def sendError(self, status, message):
+        self.sendBody(status, message.encode('utf-8'), 'text/plain; charset=utf-8', cacheable=False)
+
+## threaded HTTP server serving the .med files under 'rootpath'
+##   cachemb: memory limit of the hot-tile cache (encoded tiles) in MB
+##   maxage: Cache-Control max-age (seconds) of tiles and ROIs, ETags change if a .med file is rewritten
+class MEDTileServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, rootpath, host='127.0.0.1', port=8000, cachemb=256, maxage=3600, maxroipixels=64*1024*1024, quiet=False):
+        super().__init__((host, port), MEDTileHandler)
+        self.rootpath = os.path.realpath(rootpath)
+        self.hottiles = mf.TileCache(maxmb=cachemb)
+        self.maxage = maxage
+        self.maxroipixels = maxroipixels
+        self.quiet = quiet
+        self.requests = 0
+        self.latencies = deque(maxlen=10000)
+        self._statslock = threading.Lock()
+
+    def listSlides(self):
+        medlist = glob.glob(os.path.join(self.rootpath, '**', '*.med'), recursive=True)
+        return sorted(os.path.relpath(medfname, self.rootpath).replace(os.sep, '/') for medfname in medlist)
+
+    ## .med file of a URL path, None if it does not exist or is outside rootpath
+    def resolveSlide(self, relpath):
+        medfname = os.path.realpath(os.path.join(self.rootpath, relpath))
+        if not medfname.startswith(self.rootpath + os.sep) or not os.path.isfile(medfname):
+            return None
+        return medfname
+
+    def logRequest(self, method, path, status, nbytes, elapsed):
+        with self._statslock:
+            self.requests += 1
+            self.latencies.append(elapsed)
+        if not self.quiet:
+            aux.printmsg(f'[LOG] {method} {path} {status} {nbytes}B {elapsed*1000:.1f}ms')
+
+    def stats(self):
+        with self._statslock:
+            latencies = np.array(self.latencies) * 1000
+            requests = self.requests
+        latency = {}
+        if len(latencies) > 0:
+            latency = {f'p{q}_ms': round(float(np.percentile(latencies, q)), 2) for q in (50, 95, 99)}
+            latency['mean_ms'] = round(float(latencies.mean()), 2)
+        return {'requests': requests, 'latency': latency, 'hottiles': self.hottiles.stats(), 'tilecache': mf.TILECACHE.stats()}
+
+def main():
+    parser = argparse.ArgumentParser(description='local DeepZoom tile server for .med files')
+    parser.add_argument('rootpath', help='folder containing the .med files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-mb', type=int, default=256, help='memory limit of the hot-tile cache in MB')
+    parser.add_argument('--max-age', type=int, default=3600, help='Cache-Control max-age of tiles and ROIs in seconds')
+    parser.add_argument('--quiet', action='store_true', help='do not print a log line per request')
+    args = parser.parse_args()
+    server = MEDTileServer(args.rootpath, args.host, args.port, args.cache_mb, args.max_age, quiet=args.quiet)
+    aux.printmsg(f'[INFO] serving {len(server.listSlides())} .med files of {server.rootpath} on http://{args.host}:{args.port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        mf.closeAllMEDfiles()
+
+if __name__ == '__main__':
+    main()